@@ -0,0 +1,71 @@
+"""
+Compares the former row by row GAnalytics4Connector.get_df_from_response with the columnar decoder
+on synthetic RunReportResponse objects.
+
+    python benchmarks/bench_ga4_get_df_from_response.py --rows 100000 1000000
+"""
+import argparse
+import time
+
+import pandas as pd
+from google.analytics.data_v1beta.types import MetricHeader
+from google.analytics.data_v1beta.types import MetricType
+from google.analytics.data_v1beta.types import RunReportResponse
+
+from gcloud_connectors.ga4 import GAnalytics4Connector
+
+DIMENSIONS = ['date', 'country', 'deviceCategory', 'sessionSource']
+METRICS = ['sessions', 'totalUsers', 'engagementRate', 'userEngagementDuration', 'purchaseRevenue']
+METRIC_TYPES = [MetricType.TYPE_INTEGER, MetricType.TYPE_INTEGER, MetricType.TYPE_FLOAT, MetricType.TYPE_SECONDS,
+                MetricType.TYPE_CURRENCY]
+
+
+def legacy_get_df_from_response(response, dimensions, metrics):
+    output = []
+    for row in response.rows:
+        current_row = {}
+        for dim in dimensions:
+            current_row[dim] = row.dimension_values[dimensions.index(dim)].value
+        for metr in metrics:
+            current_row[metr] = row.metric_values[metrics.index(metr)].value
+        output.append(current_row)
+    return pd.DataFrame(output)
+
+
+def make_response(rows):
+    response = RunReportResponse(
+        metric_headers=[MetricHeader(name=name, type_=metric_type) for name, metric_type in zip(METRICS, METRIC_TYPES)],
+        row_count=rows)
+    # rows are appended on the raw protobuf, building proto-plus Rows one by one would dominate the setup time
+    pb_rows = RunReportResponse.pb(response).rows
+    for i in range(rows):
+        row = pb_rows.add()
+        for value in ('2024{:02d}{:02d}'.format(i % 12 + 1, i % 28 + 1), 'country{}'.format(i % 150),
+                      ('desktop', 'mobile', 'tablet')[i % 3], 'source{}'.format(i % 1000)):
+            row.dimension_values.add().value = value
+        for value in (str(i % 5000), str(i % 3000), '{:.6f}'.format((i % 997) / 997), str(i % 86400),
+                      '{:.2f}'.format((i % 10007) / 7)):
+            row.metric_values.add().value = value
+    return response
+
+
+def timeit(label, func, response):
+    start = time.perf_counter()
+    func(response, DIMENSIONS, METRICS)
+    print('{:<30} {:8.2f}s'.format(label, time.perf_counter() - start))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000, 1000000])
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        response = make_response(rows)
+        print('rows: {}'.format(rows))
+        timeit('legacy get_df_from_response', legacy_get_df_from_response, response)
+        timeit('get_df_from_response', GAnalytics4Connector.get_df_from_response, response)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Compares the former per-column fallback of BigQueryConnector.pd_cast_dtypes with SchemaCaster
+on a DataFrame whose bulk astype fails (nullable integers and booleans, numbers as strings).
+
+    python benchmarks/bench_pd_cast_dtypes.py --rows 10000000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from google.cloud.bigquery import SchemaField
+
+from gcloud_connectors.bigquery import BigQueryConnector
+from gcloud_connectors.bq_dtypes import SchemaCaster
+
+SCHEMA = [
+    SchemaField('id', 'INTEGER'),
+    SchemaField('amount', 'FLOAT'),
+    SchemaField('is_active', 'BOOLEAN'),
+    SchemaField('country', 'STRING'),
+]
+
+TABLE_DTYPES = {'id': 'int', 'amount': 'float', 'is_active': 'bool', 'country': str}
+
+
+def legacy_pd_cast_dtypes(df, table_dtypes):
+    """
+    :param df: pandas DataFrame coming from BigQuery sql
+    :param table_dtypes: pandas dtypes
+    :return: pandas DataFrame casted
+    """
+    table_dtypes = {col: d_type for col, d_type in table_dtypes.items() if col in df.columns}
+    try:
+        df = df.astype(table_dtypes)
+    except Exception as e:
+        print(e)
+        for col, d_type in table_dtypes.items():
+            if col in df.columns:
+                try:
+                    if d_type == 'integer':
+                        d_type = int
+                    if d_type == 'float':
+                        d_type = float
+                    if d_type == 'string' or d_type == 'category' or d_type == str:
+                        d_type = str
+                    if d_type in (str, float, int):
+                        if d_type in (float, int):
+                            pass
+                            # df[col] = pd.to_numeric(df[col], errors='coerce')
+                        df[col] = df[col].astype(d_type)
+                    if d_type in ('boolean', 'bool'):
+                        try:
+                            df[col] = df[col].astype(int).fillna(False)
+                        except Exception as e:
+                            pass
+                        df[col] = df[col].replace({1: True, 0: False})
+                except Exception as e:
+                    print('No casting for {} into {} from {}'.format(col, d_type, df[col].dtype))
+                    print(e)
+    return df
+
+
+def make_df(rows):
+    rng = np.random.default_rng(0)
+    ids = rng.integers(0, 1 << 40, rows).astype('float')
+    ids[::97] = np.nan
+    is_active = rng.integers(0, 2, rows).astype('float')
+    is_active[::89] = np.nan
+    return pd.DataFrame({
+        'id': ids,
+        'amount': rng.random(rows).round(2).astype(str),
+        'is_active': is_active,
+        'country': pd.Categorical(rng.choice(['IT', 'FR', 'DE', 'ES'], rows)).astype(object),
+    })
+
+
+def timeit(label, func, df):
+    start = time.perf_counter()
+    func(df.copy())
+    print('{:<30} {:8.2f}s'.format(label, time.perf_counter() - start))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=10000000)
+    args = parser.parse_args()
+
+    df = make_df(args.rows)
+    caster = SchemaCaster.from_schema(SCHEMA)
+    print('rows: {}'.format(args.rows))
+    timeit('legacy pd_cast_dtypes', lambda x: legacy_pd_cast_dtypes(x, TABLE_DTYPES), df)
+    timeit('pd_cast_dtypes', lambda x: BigQueryConnector.pd_cast_dtypes(x, TABLE_DTYPES), df)
+    timeit('SchemaCaster.cast', caster.cast, df)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,229 @@
+import asyncio
+import functools
 import math
+import queue
+import random
+import tempfile
+import threading
 import time
+import uuid
+from datetime import datetime, timedelta
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import db_dtypes
+import pandas as pd
+import pyarrow as pa
 from retry import retry
+import pyarrow.parquet as pq
 from google.cloud import bigquery
+from google.cloud import bigquery_storage_v1
+from google.cloud import storage
+from google.cloud.bigquery_storage_v1 import types as bqstorage_types
 from google.oauth2 import service_account
 from google.api_core import exceptions
 import google.auth
 
+from gcloud_connectors.bq_dtypes import SchemaCaster
+from gcloud_connectors.cache import JsonStateStore, get_shared_schema_cache, get_table_key
 from gcloud_connectors.logger import EmptyLogger
+from gcloud_connectors.pa_utils import iter_arrow_tables
+
+_STREAM_DONE = object()
+
+_PARTITION_ID_FORMATS = {4: '%Y', 6: '%Y%m', 8: '%Y%m%d', 10: '%Y%m%d%H'}
+
+_LEGACY_PANDAS_DTYPES = {
+    'STRING': str,
+    'GEOGRAPHY': str,
+    'DATE': 'datetime64[ns]',
+    'DATETIME': 'datetime64[ns]',
+    'TIMESTAMP': 'datetime64[ns]',
+    'FLOAT': 'float',
+    'FLOAT64': 'float',
+    'INTEGER': 'int',
+    'INT64': 'int',
+    'BOOLEAN': 'bool',
+    'BOOL': 'bool',
+    'NUMERIC': 'object',
+    'BIGNUMERIC': 'object',
+    'TIME': 'object',
+    'BYTES': 'object',
+    'JSON': 'object',
+    'RECORD': 'object',
+    'STRUCT': 'object',
+}
+
+
+def _read_stream_batches(read_client, stream_name, schema):
+    """
+    :param read_client: BigQuery Storage read client
+    :param stream_name: name of the read stream to consume
+    :param schema: pyarrow Schema of the read session
+    :return: generator of pyarrow RecordBatches decoded from the stream
+    """
+    for response in read_client.read_rows(stream_name):
+        yield pa.ipc.read_record_batch(pa.py_buffer(response.arrow_record_batch.serialized_record_batch), schema)
+
+
+JobProgress = namedtuple('JobProgress', ['job_id', 'state', 'total_bytes_processed', 'slot_millis', 'elapsed'])
+
+QueryEstimate = namedtuple('QueryEstimate', ['total_bytes_processed', 'referenced_tables', 'cache_hit'])
+
+
+def _can_cast_timestamp_ns(column):
+    try:
+        column.cast(pa.timestamp('ns'))
+    except pa.ArrowInvalid:
+        return False
+    return True
+
+
+def _to_dataframe(table):
+    """
+    Converts an Arrow table with the default dtypes of RowIterator.to_dataframe: nullable Int64 and boolean,
+    dbdate and dbtime, dates and timestamps out of the nanoseconds range as objects.
+
+    :param table: pyarrow Table of query results
+    :return: pandas DataFrame
+    """
+    date_as_object = not all(_can_cast_timestamp_ns(column) for column in table.columns
+                             if pa.types.is_date(column.type))
+    timestamp_as_object = not all(_can_cast_timestamp_ns(column) for column in table.columns
+                                  if pa.types.is_timestamp(column.type))
+
+    def types_mapper(arrow_type):
+        if pa.types.is_boolean(arrow_type):
+            return pd.BooleanDtype()
+        if pa.types.is_integer(arrow_type):
+            return pd.Int64Dtype()
+        if pa.types.is_date(arrow_type) and not date_as_object:
+            return db_dtypes.DateDtype()
+        if pa.types.is_time(arrow_type):
+            return db_dtypes.TimeDtype()
+        return None
+
+    return table.to_pandas(date_as_object=date_as_object, timestamp_as_object=timestamp_as_object,
+                           integer_object_nulls=True, types_mapper=types_mapper)
+
+
+class BigQueryError(Exception):
+    """Base class for BigQuery connector exceptions"""
+
+
+class QueryTimeoutError(BigQueryError):
+    """Raised when a job does not complete before the waiter timeout, the job is cancelled"""
+    pass
+
+
+class QueryBudgetError(BigQueryError):
+    """Raised when a query would process more bytes than max_bytes_billed, the query is not run"""
+    pass
+
+
+class QueryJobWaiter:
+    """
+    Waits for BigQuery jobs polling their state with exponential backoff and jitter instead of spinning.
+    Jobs are cancelled server side when the timeout expires or on KeyboardInterrupt, and every poll is
+    reported to on_progress with bytes processed and slot milliseconds.
+    """
+
+    def __init__(self, initial_delay=0.5, max_delay=10, multiplier=2, jitter=0.1, timeout=None, on_progress=None,
+                 logger=None):
+        """
+        :param initial_delay: seconds before the second poll
+        :param max_delay: max seconds between two polls
+        :param multiplier: factor applied to the delay after every poll
+        :param jitter: random fraction added or removed from every delay
+        :param timeout: seconds after which a job is cancelled, None to wait forever
+        :param on_progress: function called with a JobProgress after every poll
+        :param logger: logger, default does not log
+        """
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.timeout = timeout
+        self.on_progress = on_progress
+        self.logger = logger if logger is not None else EmptyLogger()
+
+    def delays(self, initial_delay=None, max_delay=None):
+        """
+        :param initial_delay: seconds before the second poll, default the waiter initial_delay
+        :param max_delay: max seconds between two polls, default the waiter max_delay
+        :return: endless generator of seconds to sleep between polls
+        """
+        delay = initial_delay if initial_delay is not None else self.initial_delay
+        max_delay = max_delay if max_delay is not None else self.max_delay
+        while True:
+            yield delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+            delay = min(delay * self.multiplier, max_delay)
+
+    def cancel(self, job):
+        self.logger.warning('cancelling job {}'.format(job.job_id))
+        try:
+            job.cancel()
+        except Exception as e:
+            self.logger.error('could not cancel job {}: {}'.format(job.job_id, e))
+
+    def poll(self, job, started):
+        """
+        Reloads the job state once, reporting its progress and cancelling it when the timeout expired.
+
+        :param job: BigQuery job
+        :param started: time.time() when the job was submitted
+        :return: True if the job is done
+        """
+        done = job.done()
+        elapsed = time.time() - started
+        if self.on_progress is not None:
+            self.on_progress(JobProgress(job_id=job.job_id, state=job.state,
+                                         total_bytes_processed=getattr(job, 'total_bytes_processed', None),
+                                         slot_millis=getattr(job, 'slot_millis', None), elapsed=elapsed))
+        if not done and self.timeout is not None and elapsed >= self.timeout:
+            self.cancel(job)
+            raise QueryTimeoutError('job {} not completed after {} seconds'.format(job.job_id, self.timeout))
+        return done
+
+    def wait(self, job, started=None):
+        """
+        :param job: BigQuery job
+        :param started: time.time() when the job was submitted, default now
+        :return: the job, once done
+        """
+        started = started if started is not None else time.time()
+        delays = self.delays()
+        try:
+            while not self.poll(job, started):
+                delay = next(delays)
+                if self.timeout is not None:
+                    delay = min(delay, max(started + self.timeout - time.time(), 0))
+                self.logger.info('waiting for job {} completion'.format(job.job_id))
+                time.sleep(delay)
+        except KeyboardInterrupt:
+            self.cancel(job)
+            raise
+        return job
 
 
 class BigQueryConnector:
-    def __init__(self, project_id, confs_path=None, auth_type='service_account', json_keyfile_dict=None, logger=None):
+    def __init__(self, project_id, confs_path=None, auth_type='service_account', json_keyfile_dict=None, logger=None,
+                 schema_cache=None, result_cache=None, job_waiter=None, max_bytes_billed=None, dry_run_guard=False):
+        """
+        :param project_id: Google Cloud project id
+        :param confs_path: path of the service account json keyfile
+        :param auth_type: authentication type
+        :param json_keyfile_dict: service account json keyfile as dict
+        :param logger: logger, default does not log
+        :param schema_cache: SchemaCache for table metadata lookups, True to use the one shared in the process,
+                             None to always call get_table
+        :param result_cache: ResultCache where pd_execute and pa_execute results are stored and read back,
+                             None to always run queries
+        :param job_waiter: QueryJobWaiter used by every method waiting for query jobs
+        :param max_bytes_billed: max bytes billed by every query, BigQuery fails queries going over it
+        :param dry_run_guard: whether to estimate every query with a dry run and raise QueryBudgetError
+                              before running the ones over max_bytes_billed
+        """
         self.confs_path = confs_path
         self.json_keyfile_dict = json_keyfile_dict
         self.auth_type = auth_type
@@ -37,6 +250,13 @@ class BigQueryConnector:
                 ]
             )
         self.service = bigquery.Client(project=self.project_id, credentials=self.creds)
+        self.bqstorage_service = None
+        self.storage_service = None
+        self.schema_cache = get_shared_schema_cache() if schema_cache is True else schema_cache
+        self.result_cache = result_cache
+        self.job_waiter = job_waiter if job_waiter is not None else QueryJobWaiter(logger=self.logger)
+        self.max_bytes_billed = max_bytes_billed
+        self.dry_run_guard = dry_run_guard
         self.destination = None
         self.results_per_page = None
         self.num_pages = None
@@ -44,40 +264,23 @@ class BigQueryConnector:
         self.next_token = None
 
     @staticmethod
-    def pd_cast_dtypes(df, table_dtypes):
+    def pd_cast_dtypes(df, table_dtypes, logger=None):
         """
         :param df: pandas DataFrame coming from BigQuery sql
         :param table_dtypes: pandas dtypes
+        :param logger: logger reporting the columns that could not be casted
         :return: pandas DataFrame casted
         """
+        logger = logger if logger is not None else EmptyLogger()
         table_dtypes = {col: d_type for col, d_type in table_dtypes.items() if col in df.columns}
         try:
             df = df.astype(table_dtypes)
         except Exception as e:
-            print(e)
-            for col, d_type in table_dtypes.items():
-                if col in df.columns:
-                    try:
-                        if d_type == 'integer':
-                            d_type = int
-                        if d_type == 'float':
-                            d_type = float
-                        if d_type == 'string' or d_type == 'category' or d_type == str:
-                            d_type = str
-                        if d_type in (str, float, int):
-                            if d_type in (float, int):
-                                pass
-                                # df[col] = pd.to_numeric(df[col], errors='coerce')
-                            df[col] = df[col].astype(d_type)
-                        if d_type in ('boolean', 'bool'):
-                            try:
-                                df[col] = df[col].astype(int).fillna(False)
-                            except Exception as e:
-                                pass
-                            df[col] = df[col].replace({1: True, 0: False})
-                    except Exception as e:
-                        print('No casting for {} into {} from {}'.format(col, d_type, df[col].dtype))
-                        print(e)
+            logger.info('falling back to nullable dtypes casting: {}'.format(e))
+            df, failures = SchemaCaster.from_pandas_dtypes(table_dtypes).cast(df)
+            for failure in failures:
+                logger.warning('No casting for {} into {} from {}: {}'.format(
+                    failure.column, failure.target_dtype, failure.source_dtype, failure.error))
         return df
 
     def pd_get_dtypes(self, dataset, table):
@@ -88,6 +291,15 @@ class BigQueryConnector:
         """
         return self.get_pandas_dtypes(dataset, table)
 
+    def get_table(self, table_ref):
+        """
+        :param table_ref: table id like dataset.table or project.dataset.table
+        :return: BigQuery Table, from the schema cache when enabled
+        """
+        if self.schema_cache is not None:
+            return self.schema_cache.get_table(self.service, table_ref)
+        return self.service.get_table(table_ref)
+
     def get_pandas_dtypes(self, dataset, table):
         """
         :param dataset: BigQuery dataset name like bigquery-public-data.bitcoin_blockchain
@@ -95,44 +307,474 @@ class BigQueryConnector:
         :return: dict of column types as {col1: dtype1, col2: dtype1, col3: dtype3....}
         """
         table_ref = '{}.{}'.format(dataset, table)
-        table = self.service.get_table(table_ref)
+        table = self.get_table(table_ref)
         schema_dtypes = {}
         for schema in table.schema:
-            if schema.field_type in ['STRING']:
-                type_x = str
-            elif schema.field_type in ['DATE', 'TIMESTAMP']:
-                type_x = 'datetime64[ns]'
-            elif schema.field_type in ['FLOAT']:
-                type_x = schema.field_type.lower()
-            elif schema.field_type in ['INTEGER']:
-                type_x = 'int'
-            elif schema.field_type in ['BOOLEAN']:
-                type_x = 'bool'
+            if schema.mode == 'REPEATED':
+                type_x = 'object'
+            elif schema.field_type in _LEGACY_PANDAS_DTYPES:
+                type_x = _LEGACY_PANDAS_DTYPES[schema.field_type]
             else:
                 raise AttributeError('Unknown type {} for {}'.format(schema.field_type, schema.name))
             schema_dtypes[schema.name] = type_x
         return schema_dtypes
 
-    def pd_execute(self, query, progress_bar_type=None, bqstorage_enabled=False):
+    def get_schema_caster(self, dataset, table):
+        """
+        :param dataset: BigQuery dataset name like bigquery-public-data.bitcoin_blockchain
+        :param table: BigQuery table name like blocks
+        :return: SchemaCaster converting DataFrames to the nullable pandas dtypes of the table schema
+        """
+        table_ref = '{}.{}'.format(dataset, table)
+        return SchemaCaster.from_schema(self.get_table(table_ref).schema)
+
+    def get_bqstorage_client(self):
+        """
+        :return: BigQuery Storage read client, created on first use with the connector credentials
+        """
+        if self.bqstorage_service is None:
+            self.bqstorage_service = bigquery_storage_v1.BigQueryReadClient(credentials=self.creds)
+        return self.bqstorage_service
+
+    def _create_read_session(self, table, max_streams):
+        """
+        :param table: BigQuery Table to read
+        :param max_streams: max number of parallel read streams requested to the server
+        :return: BigQuery Storage ReadSession in Arrow format
+        """
+        read_session = bqstorage_types.ReadSession(
+            table='projects/{}/datasets/{}/tables/{}'.format(table.project, table.dataset_id, table.table_id),
+            data_format=bqstorage_types.DataFormat.ARROW,
+        )
+        return self.get_bqstorage_client().create_read_session(
+            parent='projects/{}'.format(self.project_id),
+            read_session=read_session,
+            max_stream_count=max_streams,
+        )
+
+    @staticmethod
+    def _get_session_schema(session):
+        return pa.ipc.read_schema(pa.py_buffer(session.arrow_schema.serialized_schema))
+
+    def _iter_session_batches(self, session, max_workers=None, max_queue_size=64):
+        """
+        Consumes every stream of the read session in a thread pool and yields the decoded record batches
+        as soon as they are available, so batches are not ordered as in the table.
+
+        :param session: BigQuery Storage ReadSession in Arrow format
+        :param max_workers: number of threads consuming the streams, default one per stream
+        :param max_queue_size: max number of decoded batches waiting to be consumed
+        :return: generator of pyarrow RecordBatches
+        """
+        streams = list(session.streams)
+        if not streams:
+            return
+        read_client = self.get_bqstorage_client()
+        schema = self._get_session_schema(session)
+        batches = queue.Queue(maxsize=max_queue_size)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def consume(stream_name):
+            if stop.is_set():
+                # the consumer is gone, streams still waiting for a thread are not opened
+                return
+            try:
+                for batch in _read_stream_batches(read_client, stream_name, schema):
+                    if not put(batch):
+                        return
+            except Exception as e:
+                put(e)
+            finally:
+                put(_STREAM_DONE)
+
+        with ThreadPoolExecutor(max_workers=max_workers or len(streams)) as executor:
+            for stream in streams:
+                executor.submit(consume, stream.name)
+            try:
+                remaining = len(streams)
+                while remaining:
+                    item = batches.get()
+                    if item is _STREAM_DONE:
+                        remaining -= 1
+                    elif isinstance(item, Exception):
+                        raise item
+                    else:
+                        yield item
+            finally:
+                stop.set()
+
+    def _get_job_config(self, query_parameters=None, dry_run=False):
+        """
+        :param query_parameters: list of BigQuery query parameters
+        :param dry_run: whether to only validate the query and estimate its cost
+        :return: QueryJobConfig or None when no option is set
+        """
+        if not query_parameters and not dry_run and self.max_bytes_billed is None:
+            return None
+        job_config = bigquery.QueryJobConfig(query_parameters=query_parameters or [])
+        if dry_run:
+            job_config.dry_run = True
+        elif self.max_bytes_billed is not None:
+            job_config.maximum_bytes_billed = self.max_bytes_billed
+        return job_config
+
+    def estimate(self, query, query_parameters=None):
+        """
+        Validates the query with a dry run, nothing is billed.
+
+        :param query: sql query
+        :param query_parameters: list of BigQuery query parameters
+        :return: QueryEstimate with total bytes processed, referenced tables as project.dataset.table
+                 and whether BigQuery reported the results as cached, when available
+        """
+        query_job = self.service.query(query, job_config=self._get_job_config(query_parameters, dry_run=True))
+        return QueryEstimate(total_bytes_processed=query_job.total_bytes_processed or 0,
+                             referenced_tables=[get_table_key(table_ref) for table_ref in query_job.referenced_tables],
+                             cache_hit=query_job.cache_hit)
+
+    def check_budget(self, query, query_parameters=None):
+        """
+        :param query: sql query
+        :param query_parameters: list of BigQuery query parameters
+        :return: QueryEstimate of the query if within max_bytes_billed, otherwise raises QueryBudgetError
+        """
+        query_estimate = self.estimate(query, query_parameters=query_parameters)
+        if self.max_bytes_billed is not None and query_estimate.total_bytes_processed > self.max_bytes_billed:
+            raise QueryBudgetError('query would process {} bytes, over max_bytes_billed {}'.format(
+                query_estimate.total_bytes_processed, self.max_bytes_billed))
+        return query_estimate
+
+    def _submit_query(self, query, query_parameters=None):
+        """
+        :param query: sql query
+        :param query_parameters: list of BigQuery query parameters
+        :return: running BigQuery query job, after the dry run budget check when dry_run_guard is enabled
+        """
+        if self.dry_run_guard:
+            self.check_budget(query, query_parameters=query_parameters)
+        return self.service.query(query, job_config=self._get_job_config(query_parameters))
+
+    def _run_query(self, query, query_parameters=None):
+        """
+        :param query: sql query
+        :param query_parameters: list of BigQuery query parameters
+        :return: completed BigQuery query job
+        """
+        query_job = self._submit_query(query, query_parameters=query_parameters)
+        self.job_waiter.wait(query_job)
+        query_job.result()
+        return query_job
+
+    def _query_destination(self, query, sleep_time=None):
+        return self._get_destination_table(self._run_query(query), sleep_time=sleep_time)
+
+    def iter_arrow_batches(self, query, max_streams=8, max_workers=None):
+        """
+        Runs the query and reads its results through the BigQuery Storage Read API opening up to max_streams
+        streams in parallel. Batches are yielded as soon as any stream decodes them, so they do not follow
+        the query order.
+
+        :param query: sql query
+        :param max_streams: max number of parallel read streams
+        :param max_workers: number of threads consuming the streams, default one per stream
+        :return: generator of pyarrow RecordBatches from BigQuery sql execution
+        """
+        session = self._create_read_session(self._query_destination(query), max_streams)
+        for batch in self._iter_session_batches(session, max_workers=max_workers):
+            yield batch
+
+    def _pa_read_streams(self, table, max_streams, max_workers=None):
+        session = self._create_read_session(table, max_streams)
+        batches = list(self._iter_session_batches(session, max_workers=max_workers))
+        return pa.Table.from_batches(batches, schema=self._get_session_schema(session))
+
+    @staticmethod
+    def pa_to_pandas(table, arrow_dtypes=False, bigquery_dtypes=False):
+        """
+        :param table: pyarrow Table
+        :param arrow_dtypes: whether to keep Arrow-backed pandas dtypes instead of converting to numpy ones
+        :param bigquery_dtypes: whether to convert with the default dtypes of RowIterator.to_dataframe, like
+                                Int64, boolean and dbdate, so results match a query downloaded with to_dataframe
+        :return: pandas DataFrame
+        """
+        if arrow_dtypes:
+            return table.to_pandas(types_mapper=pd.ArrowDtype)
+        if bigquery_dtypes:
+            return _to_dataframe(table)
+        return table.to_pandas()
+
+    def _get_table_modified(self, table_ref):
+        # schema_cache entries may be stale, table validation needs the current last modified time
+        modified = self.service.get_table(table_ref).modified
+        return modified.isoformat() if modified is not None else None
+
+    def _get_referenced_tables(self, query_job):
+        if not self.result_cache.validate_tables:
+            return {}
+        referenced_tables = {}
+        for table_ref in query_job.referenced_tables:
+            table_key = get_table_key(table_ref)
+            referenced_tables[table_key] = self._get_table_modified(table_key)
+        return referenced_tables
+
+    def pa_execute(self, query, bqstorage_enabled=False, bqstorage_streams=None, max_workers=None,
+                   query_parameters=None, use_cache=True):
+        """
+        :param query: sql query
+        :param bqstorage_enabled: whether to user or not bqstorage to download results more quickly
+        :param bqstorage_streams: if set, reads the results with this max number of parallel bqstorage streams
+                                  decoded concurrently, row order is not preserved
+        :param max_workers: number of threads consuming the bqstorage streams, default one per stream
+        :param query_parameters: list of BigQuery query parameters
+        :param use_cache: whether to use the connector result_cache, if any
+        :return: pyarrow Table from BigQuery sql execution, typed after the BigQuery schema
+        """
+        use_cache = use_cache and self.result_cache is not None
+        if use_cache:
+            key = self.result_cache.get_key(query, self.project_id, query_parameters)
+            table = self.result_cache.get(key, get_modified=self._get_table_modified)
+            if table is not None:
+                self.logger.info('query results read from cache {}'.format(key))
+                return table
+
+        query_job = self._run_query(query, query_parameters=query_parameters)
+        if bqstorage_streams:
+            table = self._pa_read_streams(self._get_destination_table(query_job), bqstorage_streams,
+                                          max_workers=max_workers)
+        else:
+            table = query_job.result().to_arrow(create_bqstorage_client=bqstorage_enabled is True)
+
+        if use_cache:
+            self.result_cache.put(key, table, referenced_tables=self._get_referenced_tables(query_job))
+        return table
+
+    def pd_execute(self, query, progress_bar_type=None, bqstorage_enabled=False, bqstorage_streams=None,
+                   max_workers=None, arrow_dtypes=False, query_parameters=None, use_cache=True):
         """
         :param query: sql query
         :param progress_bar_type:
         :param bqstorage_enabled: whether to user or not bqstorage to download results more quickly
+        :param bqstorage_streams: if set, reads the results with this max number of parallel bqstorage streams
+                                  decoded concurrently, row order is not preserved
+        :param max_workers: number of threads consuming the bqstorage streams, default one per stream
+        :param arrow_dtypes: whether to return Arrow-backed pandas dtypes taken from the BigQuery schema,
+                             no further pd_cast_dtypes is needed
+        :param query_parameters: list of BigQuery query parameters
+        :param use_cache: whether to use the connector result_cache, if any
         :return: pandas DataFrame from BigQuery sql execution
         """
         del progress_bar_type
+        if bqstorage_streams or arrow_dtypes or (use_cache and self.result_cache is not None):
+            return self.pa_to_pandas(
+                self.pa_execute(query, bqstorage_enabled=bqstorage_enabled, bqstorage_streams=bqstorage_streams,
+                                max_workers=max_workers, query_parameters=query_parameters, use_cache=use_cache),
+                arrow_dtypes=arrow_dtypes, bigquery_dtypes=True)
+        query_job = self._run_query(query, query_parameters=query_parameters)
+        return self._job_to_dataframe(query_job, bqstorage_enabled=bqstorage_enabled)
+
+    def _job_to_dataframe(self, query_job, bqstorage_enabled=False, arrow_dtypes=False):
+        """
+        :param query_job: BigQuery query job, waited for completion
+        :param bqstorage_enabled: whether to user or not bqstorage to download results more quickly
+        :param arrow_dtypes: whether to return Arrow-backed pandas dtypes taken from the BigQuery schema
+        :return: pandas DataFrame of the query job results
+        """
+        rows = query_job.result()
+        if arrow_dtypes:
+            return self.pa_to_pandas(rows.to_arrow(create_bqstorage_client=bqstorage_enabled is True),
+                                     arrow_dtypes=True)
         if bqstorage_enabled is True:
-            return (
-                self.service.query(query)
-                    .result()
-                    .to_dataframe(create_bqstorage_client=True)
-            )
+            return rows.to_dataframe(create_bqstorage_client=True)
         else:
-            return (
-                self.service.query(query)
-                    .result()
-                    .to_dataframe()
-            )
+            return rows.to_dataframe()
+
+    def _download_job(self, index, query_job, bqstorage_enabled, arrow_dtypes):
+        return index, self._job_to_dataframe(query_job, bqstorage_enabled=bqstorage_enabled, arrow_dtypes=arrow_dtypes)
+
+    def _iter_execute_many(self, queries, max_concurrency, max_workers, bqstorage_enabled, arrow_dtypes,
+                           poll_interval, max_poll_interval):
+        pending_queries = list(enumerate(queries))[::-1]
+        running = {}
+        downloads = set()
+        delays = self.job_waiter.delays(poll_interval, max_poll_interval)
+        next_poll = 0
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers or max_concurrency) as executor:
+                while pending_queries or running or downloads:
+                    while pending_queries and len(running) < max_concurrency:
+                        index, query = pending_queries.pop()
+                        running[index] = (self._submit_query(query), time.time())
+
+                    if running and time.time() >= next_poll:
+                        finished = [index for index, (query_job, started) in running.items()
+                                    if self.job_waiter.poll(query_job, started)]
+                        for index in finished:
+                            self.logger.info('query {} completed'.format(index))
+                            downloads.add(executor.submit(self._download_job, index, running.pop(index)[0],
+                                                          bqstorage_enabled, arrow_dtypes))
+                        if finished:
+                            delays = self.job_waiter.delays(poll_interval, max_poll_interval)
+                        next_poll = time.time() + (next(delays) if running else 0)
+
+                    timeout = max(next_poll - time.time(), 0) if running or pending_queries else None
+                    if downloads:
+                        done, downloads = wait(downloads, timeout=timeout, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            yield future.result()
+                    elif timeout:
+                        time.sleep(timeout)
+        finally:
+            for query_job, _ in running.values():
+                self.job_waiter.cancel(query_job)
+
+    def pd_execute_many(self, queries, max_concurrency=8, max_workers=None, as_completed=False,
+                        bqstorage_enabled=False, arrow_dtypes=False, poll_interval=None, max_poll_interval=None):
+        """
+        Runs many independent queries at once: up to max_concurrency jobs are kept running on BigQuery,
+        their state is polled with the connector job_waiter backoff and the results of completed jobs are
+        downloaded in a thread pool while the others are still running.
+
+        :param queries: iterable of sql queries
+        :param max_concurrency: max number of query jobs running at the same time
+        :param max_workers: number of threads downloading results, default max_concurrency
+        :param as_completed: if True returns a generator of (query index, DataFrame) in completion order
+        :param bqstorage_enabled: whether to user or not bqstorage to download results more quickly
+        :param arrow_dtypes: whether to return Arrow-backed pandas dtypes taken from the BigQuery schema
+        :param poll_interval: initial seconds between job state polls, default the job_waiter initial_delay
+        :param max_poll_interval: max seconds between job state polls, default the job_waiter max_delay
+        :return: list of pandas DataFrames in the same order of queries
+        """
+        queries = list(queries)
+        results = self._iter_execute_many(queries, max_concurrency, max_workers, bqstorage_enabled, arrow_dtypes,
+                                          poll_interval, max_poll_interval)
+        if as_completed:
+            return results
+        dfs = [None] * len(queries)
+        for index, df in results:
+            dfs[index] = df
+        return dfs
+
+    async def apd_execute(self, query, bqstorage_enabled=False, arrow_dtypes=False, query_parameters=None,
+                          poll_interval=None, max_poll_interval=None):
+        """
+        asyncio version of pd_execute: blocking calls run in the loop default executor and the job state is
+        polled with the connector job_waiter backoff, so many queries can be awaited with asyncio.gather.
+
+        :param query: sql query
+        :param bqstorage_enabled: whether to user or not bqstorage to download results more quickly
+        :param arrow_dtypes: whether to return Arrow-backed pandas dtypes taken from the BigQuery schema
+        :param query_parameters: list of BigQuery query parameters
+        :param poll_interval: initial seconds between job state polls, default the job_waiter initial_delay
+        :param max_poll_interval: max seconds between job state polls, default the job_waiter max_delay
+        :return: pandas DataFrame from BigQuery sql execution
+        """
+        loop = asyncio.get_event_loop()
+        query_job = await loop.run_in_executor(None, functools.partial(
+            self._submit_query, query, query_parameters=query_parameters))
+        started = time.time()
+        delays = self.job_waiter.delays(poll_interval, max_poll_interval)
+        try:
+            while not await loop.run_in_executor(None, self.job_waiter.poll, query_job, started):
+                await asyncio.sleep(next(delays))
+        except asyncio.CancelledError:
+            self.job_waiter.cancel(query_job)
+            raise
+        return await loop.run_in_executor(None, functools.partial(
+            self._job_to_dataframe, query_job, bqstorage_enabled=bqstorage_enabled, arrow_dtypes=arrow_dtypes))
+
+    def _get_destination_table(self, query_job, sleep_time=None):
+        """
+        :param query_job: completed BigQuery query job
+        :param sleep_time: seconds to wait before retrying when the destination table is not yet available
+        :return: BigQuery Table holding the query results
+        """
+        destination = query_job.destination
+        try:
+            return self.service.get_table(destination)
+        except (exceptions.NotFound, AttributeError):
+            if sleep_time:
+                time.sleep(sleep_time)
+            return self.service.get_table(destination)
+
+    def _fetch_page(self, destination, page_size, page_token=None, arrow_dtypes=False, start_index=None):
+        """
+        :param destination: BigQuery Table to read from
+        :param page_size: max number of rows of the page
+        :param page_token: token of the page to read, None for the first one
+        :param arrow_dtypes: whether to return Arrow-backed pandas dtypes
+        :param start_index: offset of the first row of the page, alternative to page_token
+        :return: tuple of (pandas DataFrame, token of the next page or None)
+        """
+        rows = self.service.list_rows(destination, max_results=page_size, page_token=page_token,
+                                      start_index=start_index)
+        if arrow_dtypes:
+            df = self.pa_to_pandas(rows.to_arrow(create_bqstorage_client=False), arrow_dtypes=True)
+        else:
+            df = rows.to_dataframe(create_bqstorage_client=False)
+        return df, rows.next_page_token
+
+    def _iter_prefetched_pages(self, destination, page_size, prefetch, max_workers, arrow_dtypes):
+        """
+        Fetches pages by row offset in a thread pool, keeping at most prefetch pages downloaded or in flight
+        ahead of the consumer, and yields them in order.
+        """
+        num_pages = math.ceil(destination.num_rows / float(page_size))
+        futures = deque()
+        next_page = 0
+        with ThreadPoolExecutor(max_workers=max_workers or prefetch) as executor:
+            try:
+                while futures or next_page < num_pages:
+                    while next_page < num_pages and len(futures) < prefetch:
+                        futures.append(executor.submit(self._fetch_page, destination, page_size,
+                                                       arrow_dtypes=arrow_dtypes, start_index=next_page * page_size))
+                        next_page += 1
+                    df, _ = futures.popleft().result()
+                    yield df
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def iter_dataframes(self, query, page_size=10000, sleep_time=None, arrow_dtypes=False, prefetch=1,
+                        max_workers=None):
+        """
+        Streams the results of a query page by page without keeping any state on the connector,
+        so several queries can be iterated at the same time. The next pages are downloaded in background
+        while the current one is being consumed, keeping at most prefetch + 1 pages in memory.
+
+        :param query: sql query
+        :param page_size: max number of rows of each yielded DataFrame
+        :param sleep_time: seconds to wait before retrying when the destination table is not yet available
+        :param arrow_dtypes: whether to return Arrow-backed pandas dtypes taken from the BigQuery schema
+        :param prefetch: number of pages downloaded ahead, with more than one page they are fetched
+                         concurrently by row offset instead of following page tokens
+        :param max_workers: number of threads fetching pages, default prefetch
+        :return: generator of pandas DataFrames from BigQuery sql execution
+        """
+        destination = self._query_destination(query, sleep_time=sleep_time)
+        if not destination.num_rows:
+            return
+
+        if prefetch > 1:
+            for df in self._iter_prefetched_pages(destination, page_size, prefetch, max_workers, arrow_dtypes):
+                yield df
+            return
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(self._fetch_page, destination, page_size, arrow_dtypes=arrow_dtypes)
+            while future is not None:
+                df, next_token = future.result()
+                future = executor.submit(self._fetch_page, destination, page_size, next_token,
+                                         arrow_dtypes=arrow_dtypes) if next_token else None
+                yield df
 
     def clear_chunked_variables(self):
         self.destination = None
@@ -153,10 +795,9 @@ class BigQueryConnector:
                            results_per_page=10, sleep_time=None):
 
         if first_run:
-            query_job = self.service.query(query)
+            query_job = self._submit_query(query)
 
-            while query_job.done() is not True:
-                self.logger.info("waiting for job completion")
+            self.job_waiter.wait(query_job)
 
             try:
                 query_job.result()  # Waits for table load to complete.
@@ -164,13 +805,7 @@ class BigQueryConnector:
             except:
                 print(query_job.exception())
 
-            destination = query_job.destination
-            try:
-                destination = self.service.get_table(destination)
-            except (exceptions.NotFound, AttributeError):
-                if sleep_time:
-                    time.sleep(sleep_time)
-                destination = self.service.get_table(destination)
+            destination = self._get_destination_table(query_job, sleep_time=sleep_time)
             self.destination = destination
             self.results_per_page = results_per_page
             self.num_pages = math.ceil(float(destination.num_rows / results_per_page))
@@ -195,3 +830,233 @@ class BigQueryConnector:
 
         else:
             return None
+
+    def get_storage_client(self):
+        """
+        :return: Google Cloud Storage client, created on first use with the connector credentials
+        """
+        if self.storage_service is None:
+            self.storage_service = storage.Client(project=self.project_id, credentials=self.creds)
+        return self.storage_service
+
+    @staticmethod
+    def _get_load_job_config(write_disposition, partitioning=None, clustering=None):
+        """
+        :param write_disposition: BigQuery write disposition like WRITE_APPEND, WRITE_TRUNCATE or WRITE_EMPTY
+        :param partitioning: column name for daily partitioning or a bigquery TimePartitioning
+        :param clustering: list of clustering columns
+        :return: LoadJobConfig for Parquet sources
+        """
+        job_config = bigquery.LoadJobConfig(source_format=bigquery.SourceFormat.PARQUET,
+                                            write_disposition=write_disposition)
+        if partitioning is not None:
+            if not isinstance(partitioning, bigquery.TimePartitioning):
+                partitioning = bigquery.TimePartitioning(field=partitioning)
+            job_config.time_partitioning = partitioning
+        if clustering:
+            job_config.clustering_fields = list(clustering)
+        return job_config
+
+    @staticmethod
+    def _upload_parquet_part(blob, table):
+        sink = pa.BufferOutputStream()
+        pq.write_table(table, sink)
+        blob.upload_from_file(pa.BufferReader(sink.getvalue()), content_type='application/octet-stream')
+        return blob
+
+    def _stage_parquet_parts(self, tables, bucket, prefix, max_workers, blobs):
+        """
+        Encodes every table as a Parquet file uploaded to GCS in a thread pool, keeping at most max_workers
+        encoded files in memory. Each blob is appended to blobs before its upload starts, so the caller can delete
+        the staged files even when an upload fails.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = set()
+            try:
+                for index, table in enumerate(tables):
+                    if len(pending) >= max_workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    blob = bucket.blob('{}/part-{:05d}.parquet'.format(prefix, index))
+                    blobs.append(blob)
+                    pending.add(executor.submit(self._upload_parquet_part, blob, table))
+                for future in pending:
+                    future.result()
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+
+    def pd_to_bigquery(self, df, table, write_disposition=bigquery.WriteDisposition.WRITE_APPEND, partitioning=None,
+                       clustering=None, row_group_size=500000, staging_bucket=None,
+                       staging_prefix='tmp/pd_to_bigquery', max_workers=8):
+        """
+        Loads a pandas DataFrame into BigQuery with a single Parquet load job.
+
+        Without staging_bucket the data is written row group by row group into a local temporary Parquet file
+        uploaded with a resumable upload. With staging_bucket every row group is encoded in memory and uploaded
+        to GCS as a separate file in parallel, then loaded from there and deleted.
+
+        :param df: pandas DataFrame, pyarrow Table or an iterator of them for data not fitting in memory
+        :param table: BigQuery destination table like dataset.table or project.dataset.table
+        :param write_disposition: BigQuery write disposition like WRITE_APPEND, WRITE_TRUNCATE or WRITE_EMPTY
+        :param partitioning: column name for daily partitioning or a bigquery TimePartitioning
+        :param clustering: list of clustering columns
+        :param row_group_size: max number of rows of each Parquet row group or staged file
+        :param staging_bucket: GCS bucket where Parquet files are staged, None to upload a local file
+        :param staging_prefix: path on staging_bucket where Parquet files are staged
+        :param max_workers: number of parallel uploads to staging_bucket
+        :return: completed BigQuery LoadJob
+        """
+        job_config = self._get_load_job_config(write_disposition, partitioning=partitioning, clustering=clustering)
+        # every part of the load, or the temporary file, needs the same schema
+        tables = iter_arrow_tables(df, chunk_rows=row_group_size, hold_null_columns=True)
+
+        if staging_bucket is not None:
+            bucket = self.get_storage_client().bucket(staging_bucket)
+            prefix = '{}/{}'.format(staging_prefix.rstrip('/'), uuid.uuid4().hex)
+            blobs = []
+            try:
+                self._stage_parquet_parts(tables, bucket, prefix, max_workers, blobs)
+                if not blobs:
+                    raise ValueError('No data to load into {}'.format(table))
+                uris = ['gs://{}/{}'.format(staging_bucket, blob.name) for blob in blobs]
+                load_job = self.service.load_table_from_uri(uris, table, job_config=job_config)
+                load_job.result()
+            finally:
+                for blob in blobs:
+                    try:
+                        blob.delete()
+                    except exceptions.NotFound:
+                        # cancelled before its upload started
+                        pass
+        else:
+            with tempfile.NamedTemporaryFile(suffix='.parquet') as temp:
+                writer = None
+                try:
+                    for chunk in tables:
+                        if writer is None:
+                            writer = pq.ParquetWriter(temp.name, chunk.schema)
+                        writer.write_table(chunk)
+                finally:
+                    if writer is not None:
+                        writer.close()
+                if writer is None:
+                    raise ValueError('No data to load into {}'.format(table))
+                with open(temp.name, 'rb') as source:
+                    load_job = self.service.load_table_from_file(source, table, job_config=job_config)
+                load_job.result()
+        self.logger.info('loaded {} rows into {}'.format(load_job.output_rows, table))
+        return load_job
+
+    def get_partitions(self, table):
+        """
+        :param table: BigQuery table like dataset.table or project.dataset.table
+        :return: pandas DataFrame of partition_id, last_modified_time, total_rows from INFORMATION_SCHEMA.PARTITIONS
+        """
+        project, dataset, table_id = get_table_key(table, default_project=self.project_id).split('.')
+        query = 'SELECT partition_id, last_modified_time, total_rows ' \
+                'FROM `{}.{}.INFORMATION_SCHEMA.PARTITIONS` ' \
+                'WHERE table_name = @table_name'.format(project, dataset)
+        return self.pd_execute(query, query_parameters=[bigquery.ScalarQueryParameter('table_name', 'STRING', table_id)],
+                               use_cache=False)
+
+    @staticmethod
+    def _get_partition_filter(table, column, column_type, partition_id, index):
+        """
+        :param table: partitioned BigQuery Table
+        :param column: partitioning column
+        :param column_type: BigQuery type of the partitioning column
+        :param partition_id: id of the partition as in INFORMATION_SCHEMA.PARTITIONS
+        :param index: suffix of the query parameters names
+        :return: tuple of (sql condition selecting the partition, list of query parameters)
+        """
+        if partition_id == '__NULL__':
+            return '`{}` IS NULL'.format(column), []
+        if table.range_partitioning is not None:
+            start = int(partition_id)
+            end = start + table.range_partitioning.range_.interval
+            parameter_type = 'INT64'
+        else:
+            start = datetime.strptime(partition_id, _PARTITION_ID_FORMATS[len(partition_id)])
+            if len(partition_id) == 10:
+                end = start + timedelta(hours=1)
+            elif len(partition_id) == 8:
+                end = start + timedelta(days=1)
+            elif len(partition_id) == 6:
+                end = start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+            else:
+                end = start.replace(year=start.year + 1)
+            parameter_type = column_type
+            if column_type == 'DATE':
+                start, end = start.date(), end.date()
+        return '(`{column}` >= @start_{index} AND `{column}` < @end_{index})'.format(column=column, index=index), [
+            bigquery.ScalarQueryParameter('start_{}'.format(index), parameter_type, start),
+            bigquery.ScalarQueryParameter('end_{}'.format(index), parameter_type, end),
+        ]
+
+    def incremental_extract(self, table, watermark_column, state_store, arrow_dtypes=False):
+        """
+        Extracts only the partitions of a partitioned table modified since the previous run. Partitions
+        last_modified_time is read from INFORMATION_SCHEMA.PARTITIONS and the highest one extracted is kept
+        as watermark of the table in state_store once the extraction succeeds. The first run extracts the
+        whole table; rows still in the streaming buffer (__UNPARTITIONED__) are left to the following runs.
+
+        :param table: BigQuery table like dataset.table or project.dataset.table
+        :param watermark_column: partitioning column, None for the table partitioning field or _PARTITIONTIME,
+                                 ValueError is raised for any other column
+        :param state_store: JsonStateStore or path of its json file
+        :param arrow_dtypes: whether to return Arrow-backed pandas dtypes taken from the BigQuery schema
+        :return: pandas DataFrame with the rows of the changed partitions
+        """
+        if not isinstance(state_store, JsonStateStore):
+            state_store = JsonStateStore(state_store)
+        table_key = get_table_key(table, default_project=self.project_id)
+        bq_table = self.get_table(table_key)
+        if bq_table.time_partitioning is None and bq_table.range_partitioning is None:
+            raise AttributeError('{} is not partitioned'.format(table_key))
+        if bq_table.range_partitioning is not None:
+            partition_columns = [bq_table.range_partitioning.field]
+        elif bq_table.time_partitioning.field is not None:
+            partition_columns = [bq_table.time_partitioning.field]
+        else:
+            partition_columns = ['_PARTITIONTIME', '_PARTITIONDATE']
+        if watermark_column is None:
+            watermark_column = partition_columns[0]
+        elif watermark_column not in partition_columns:
+            # partition ids are ranges of the partitioning column, applying them to another column selects wrong rows
+            raise ValueError('{} is partitioned by {}, watermark_column {} is not supported'.format(
+                table_key, partition_columns[0], watermark_column))
+        column_types = {field.name: field.field_type for field in bq_table.schema}
+        column_type = column_types.get(watermark_column, 'DATE' if watermark_column == '_PARTITIONDATE' else 'TIMESTAMP')
+
+        state = state_store.get(table_key, {})
+        watermark = pd.Timestamp(state['watermark']) if state.get('watermark') else None
+        partitions = self.get_partitions(table_key)
+        partitions = partitions[(partitions['partition_id'] != '__UNPARTITIONED__')
+                                & partitions['last_modified_time'].notna()]
+        if watermark is not None:
+            partitions = partitions[partitions['last_modified_time'] > watermark]
+        if partitions.empty:
+            self.logger.info('no partitions of {} changed since {}'.format(table_key, watermark))
+            return pd.DataFrame(columns=list(column_types))
+
+        query = 'SELECT * FROM `{}`'.format(table_key)
+        query_parameters = []
+        if watermark is not None:
+            conditions = []
+            for index, partition_id in enumerate(partitions['partition_id']):
+                condition, parameters = self._get_partition_filter(bq_table, watermark_column, column_type,
+                                                                   partition_id, index)
+                conditions.append(condition)
+                query_parameters.extend(parameters)
+            query = '{} WHERE {}'.format(query, ' OR '.join(conditions))
+        self.logger.info('extracting {} partitions of {}'.format(len(partitions), table_key))
+        df = self.pd_execute(query, query_parameters=query_parameters, arrow_dtypes=arrow_dtypes, use_cache=False)
+
+        state_store.set(table_key, {
+            'watermark': partitions['last_modified_time'].max().isoformat(),
+            'partitions': sorted(partitions['partition_id'].tolist()),
+        })
+        return df
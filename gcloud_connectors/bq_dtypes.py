@@ -0,0 +1,170 @@
+from collections import namedtuple
+
+import db_dtypes  # registers dbdate and dbtime pandas dtypes
+import pandas as pd
+import pyarrow as pa
+
+CastFailure = namedtuple('CastFailure', ['column', 'source_dtype', 'target_dtype', 'error'])
+
+_BOOLEAN_STRINGS = {'true': True, 'false': False, '1': True, '0': False, 't': True, 'f': False}
+
+_FIELD_TYPE_ALIASES = {
+    'INT64': 'INTEGER',
+    'FLOAT64': 'FLOAT',
+    'BOOL': 'BOOLEAN',
+    'STRUCT': 'RECORD',
+    'DECIMAL': 'NUMERIC',
+    'BIGDECIMAL': 'BIGNUMERIC',
+}
+
+
+def _cast_string(series):
+    return series.astype('string')
+
+
+def _cast_integer(series):
+    return series.astype('Int64')
+
+
+def _cast_float(series):
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype('Float64')
+    return series.astype('float64').astype('Float64')
+
+
+def _cast_boolean(series):
+    if pd.api.types.is_bool_dtype(series) or pd.api.types.is_numeric_dtype(series):
+        return series.astype('boolean')
+    casted = series.astype('string').str.lower().map(_BOOLEAN_STRINGS)
+    invalid = casted.isna() & series.notna()
+    if invalid.any():
+        raise ValueError('{} values are not booleans, e.g. {!r}'.format(invalid.sum(), series[invalid].iloc[0]))
+    return casted.astype('boolean')
+
+
+def _cast_date(series):
+    return pd.to_datetime(series)
+
+
+def _cast_timestamp(series):
+    return pd.to_datetime(series, utc=True)
+
+
+def _cast_time(series):
+    return series.astype('dbtime')
+
+
+def _cast_identity(series):
+    return series
+
+
+def _decimal_caster(precision, scale):
+    dtype = pd.ArrowDtype(pa.decimal128(precision, scale) if precision <= 38 else pa.decimal256(precision, scale))
+
+    def cast(series):
+        return series.astype(dtype)
+    return cast
+
+
+_FIELD_TYPE_CASTERS = {
+    'STRING': (_cast_string, 'string'),
+    'GEOGRAPHY': (_cast_string, 'string'),
+    'BYTES': (_cast_identity, 'object'),
+    'INTEGER': (_cast_integer, 'Int64'),
+    'FLOAT': (_cast_float, 'Float64'),
+    'NUMERIC': (_decimal_caster(38, 9), 'decimal128(38, 9)[pyarrow]'),
+    'BIGNUMERIC': (_decimal_caster(76, 38), 'decimal256(76, 38)[pyarrow]'),
+    'BOOLEAN': (_cast_boolean, 'boolean'),
+    'DATE': (_cast_date, 'datetime64[ns]'),
+    'DATETIME': (_cast_date, 'datetime64[ns]'),
+    'TIMESTAMP': (_cast_timestamp, 'datetime64[ns, UTC]'),
+    'TIME': (_cast_time, 'dbtime'),
+    'JSON': (_cast_identity, 'object'),
+    'RECORD': (_cast_identity, 'object'),
+    'INTERVAL': (_cast_identity, 'object'),
+    'RANGE': (_cast_identity, 'object'),
+}
+
+_PANDAS_DTYPE_CASTERS = {
+    'str': _FIELD_TYPE_CASTERS['STRING'],
+    'string': _FIELD_TYPE_CASTERS['STRING'],
+    'category': _FIELD_TYPE_CASTERS['STRING'],
+    'int': _FIELD_TYPE_CASTERS['INTEGER'],
+    'integer': _FIELD_TYPE_CASTERS['INTEGER'],
+    'float': _FIELD_TYPE_CASTERS['FLOAT'],
+    'bool': _FIELD_TYPE_CASTERS['BOOLEAN'],
+    'boolean': _FIELD_TYPE_CASTERS['BOOLEAN'],
+    'datetime64[ns]': _FIELD_TYPE_CASTERS['DATE'],
+}
+
+
+def get_field_caster(field):
+    """
+    :param field: BigQuery SchemaField
+    :return: tuple of (casting function for a pandas Series, target dtype name)
+    """
+    if field.mode == 'REPEATED':
+        return _cast_identity, 'object'
+    field_type = _FIELD_TYPE_ALIASES.get(field.field_type, field.field_type)
+    if field_type in ('NUMERIC', 'BIGNUMERIC') and field.precision:
+        return _decimal_caster(field.precision, field.scale or 0), 'decimal({}, {})[pyarrow]'.format(
+            field.precision, field.scale or 0)
+    if field_type not in _FIELD_TYPE_CASTERS:
+        raise AttributeError('Unknown type {} for {}'.format(field.field_type, field.name))
+    return _FIELD_TYPE_CASTERS[field_type]
+
+
+class SchemaCaster:
+    """
+    Casts pandas DataFrames to nullable pandas dtypes matching a BigQuery schema. The casting function
+    of each column is resolved once, then every column is converted with a single vectorized call.
+    """
+
+    def __init__(self, casters):
+        """
+        :param casters: dict of {col: (casting function, target dtype name)}
+        """
+        self.casters = casters
+
+    @classmethod
+    def from_schema(cls, schema):
+        """
+        :param schema: list of BigQuery SchemaField, e.g. table.schema
+        :return: SchemaCaster
+        """
+        return cls({field.name: get_field_caster(field) for field in schema})
+
+    @classmethod
+    def from_pandas_dtypes(cls, table_dtypes):
+        """
+        :param table_dtypes: dict of {col1: dtype1, col2: dtype1, col3: dtype3....} as from get_pandas_dtypes
+        :return: SchemaCaster
+        """
+        casters = {}
+        for col, d_type in table_dtypes.items():
+            key = d_type.__name__ if isinstance(d_type, type) else str(d_type)
+            if key in _PANDAS_DTYPE_CASTERS:
+                casters[col] = _PANDAS_DTYPE_CASTERS[key]
+            else:
+                casters[col] = (lambda series, d_type=d_type: series.astype(d_type)), key
+        return cls(casters)
+
+    def cast(self, df, errors='ignore'):
+        """
+        :param df: pandas DataFrame coming from BigQuery sql
+        :param errors: 'ignore' to keep the original column when its casting fails, 'raise' to raise the error
+        :return: tuple of (pandas DataFrame casted, list of CastFailure for the columns left untouched)
+        """
+        df = df.copy(deep=False)
+        failures = []
+        for col, (caster, target_dtype) in self.casters.items():
+            if col not in df.columns:
+                continue
+            try:
+                df[col] = caster(df[col])
+            except Exception as e:
+                if errors == 'raise':
+                    raise
+                failures.append(CastFailure(column=col, source_dtype=str(df[col].dtype), target_dtype=target_dtype,
+                                            error=e))
+        return df, failures
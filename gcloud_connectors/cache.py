@@ -0,0 +1,587 @@
+import glob
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+import pyarrow as pa
+from cachetools import LRUCache
+from google.cloud import bigquery
+from lockfile import LockError
+from lockfile import LockFile
+
+_shared_schema_cache = None
+_shared_schema_cache_lock = threading.Lock()
+
+# SchemaCache files are named by the sha1 of the table key, unlike ResultCache and BlobCache ones
+_SCHEMA_FILE = re.compile(r'^[0-9a-f]{40}\.json$')
+# quoted literals are kept, comments are dropped before collapsing whitespace, otherwise a -- comment would swallow
+# the code following its newline
+_SQL_TOKENS = re.compile(r"('(?:\\.|[^'\\])*'|\"(?:\\.|[^\"\\])*\"|`[^`]*`)|(?:\s|--[^\n]*|#[^\n]*|/\*.*?\*/)+",
+                         re.DOTALL)
+
+
+def _atomic_write(path, data, mode='w'):
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, mode) as temp:
+            temp.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def get_table_key(table_ref, default_project=None):
+    """
+    :param table_ref: table id like dataset.table or project.dataset.table, TableReference or Table
+    :param default_project: project used when table_ref does not specify it
+    :return: fully qualified table name as project.dataset.table
+    """
+    if isinstance(table_ref, str):
+        table_ref = bigquery.TableReference.from_string(table_ref, default_project=default_project)
+    elif isinstance(table_ref, bigquery.Table):
+        table_ref = table_ref.reference
+    return '{}.{}.{}'.format(table_ref.project, table_ref.dataset_id, table_ref.table_id)
+
+
+class SchemaCache:
+    """
+    LRU cache of BigQuery table metadata, shared by connectors to avoid a get_table round trip for every
+    schema lookup. Entries older than ttl seconds are revalidated comparing etag and last modified time,
+    and can be persisted as json in cache_dir to be reused by other processes.
+    """
+
+    def __init__(self, maxsize=256, ttl=3600, cache_dir=None):
+        """
+        :param maxsize: max number of tables kept in memory
+        :param ttl: seconds after which a cached table is revalidated, None to never revalidate
+        :param cache_dir: directory of the on-disk layer, None to keep tables only in memory
+        """
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self._tables = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, '{}.json'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()))
+
+    def _load_from_disk(self, key):
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._disk_path(key)) as cached_file:
+                cached = json.load(cached_file)
+        except (OSError, ValueError):
+            return None
+        return cached['fetched_at'], bigquery.Table.from_api_repr(cached['resource'])
+
+    def _store(self, key, fetched_at, table):
+        with self._lock:
+            self._tables[key] = (fetched_at, table)
+        if self.cache_dir is not None:
+            _atomic_write(self._disk_path(key),
+                          json.dumps({'fetched_at': fetched_at, 'resource': table.to_api_repr()}))
+
+    def _is_fresh(self, fetched_at):
+        return self.ttl is None or time.time() - fetched_at < self.ttl
+
+    @staticmethod
+    def _is_unchanged(cached_table, table):
+        if cached_table.etag and table.etag:
+            return cached_table.etag == table.etag
+        return cached_table.modified is not None and cached_table.modified == table.modified
+
+    def get_table(self, client, table_ref):
+        """
+        :param client: BigQuery client used on cache misses
+        :param table_ref: table id like dataset.table or project.dataset.table, TableReference or Table
+        :return: BigQuery Table
+        """
+        key = get_table_key(table_ref, default_project=client.project)
+        with self._lock:
+            entry = self._tables.get(key)
+        if entry is None:
+            entry = self._load_from_disk(key)
+
+        if entry is not None and self._is_fresh(entry[0]):
+            with self._lock:
+                self.hits += 1
+                self._tables[key] = entry
+            return entry[1]
+
+        table = client.get_table(key)
+        with self._lock:
+            if entry is not None and self._is_unchanged(entry[1], table):
+                self.revalidations += 1
+            else:
+                self.misses += 1
+        self._store(key, time.time(), table)
+        return table
+
+    def _iter_disk_entries(self):
+        """
+        :return: generator of (path, table key) of the on-disk layer, other files of cache_dir are skipped
+        """
+        for name in os.listdir(self.cache_dir):
+            if not _SCHEMA_FILE.match(name):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                with open(path) as cached_file:
+                    reference = json.load(cached_file)['resource']['tableReference']
+            except (OSError, ValueError, KeyError):
+                continue
+            yield path, '{}.{}.{}'.format(reference['projectId'], reference['datasetId'], reference['tableId'])
+
+    def invalidate(self, table_ref=None, default_project=None):
+        """
+        :param table_ref: table to drop from the memory and disk layers, None to clear both
+        :param default_project: project used when table_ref does not specify it, None to drop the table of every
+                                project, as get_table keys it with the project of the client
+        """
+        table_key = None
+        if table_ref is not None:
+            try:
+                table_key = get_table_key(table_ref, default_project=default_project)
+            except ValueError:
+                pass
+
+        if table_key is not None:
+            with self._lock:
+                self._tables.pop(table_key, None)
+            if self.cache_dir is not None and os.path.exists(self._disk_path(table_key)):
+                os.remove(self._disk_path(table_key))
+            return
+
+        suffix = None if table_ref is None else '.' + table_ref
+        with self._lock:
+            for key in [key for key in self._tables if suffix is None or key.endswith(suffix)]:
+                del self._tables[key]
+        if self.cache_dir is not None:
+            for path, key in self._iter_disk_entries():
+                if suffix is None or key.endswith(suffix):
+                    os.remove(path)
+
+    def info(self):
+        """
+        :return: dict of cache counters
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'revalidations': self.revalidations,
+                    'size': len(self._tables), 'maxsize': self._tables.maxsize}
+
+
+def normalize_sql(query):
+    """
+    :param query: sql query
+    :return: query without comments, with whitespace outside quoted literals collapsed and no trailing semicolon
+    """
+    normalized = _SQL_TOKENS.sub(lambda match: match.group(1) or ' ', query).strip()
+    return normalized.rstrip(';').rstrip()
+
+
+class ResultCache:
+    """
+    On-disk cache of query results stored as uncompressed Arrow IPC files, so hits are read back by memory
+    mapping without billing or downloading the query again. Files are evicted least recently used first
+    when the cache grows over max_bytes, and expire after ttl seconds. With validate_tables, an entry is
+    also dropped when the last modified time of any table referenced by the query has changed.
+    """
+
+    def __init__(self, cache_dir, max_bytes=10 * 1024 ** 3, ttl=3600, validate_tables=False):
+        """
+        :param cache_dir: directory where results are stored
+        :param max_bytes: max total size of the cached files
+        :param ttl: seconds after which a result expires, None to never expire
+        :param validate_tables: whether to compare referenced tables last modified time on every hit
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.validate_tables = validate_tables
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(query, project, query_parameters=None):
+        """
+        :param query: sql query
+        :param project: project running the query
+        :param query_parameters: list of BigQuery query parameters
+        :return: cache key of the query
+        """
+        parameters = [parameter.to_api_repr() for parameter in query_parameters or []]
+        key = json.dumps([normalize_sql(query), project, parameters], sort_keys=True, default=str)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _paths(self, key):
+        return os.path.join(self.cache_dir, '{}.arrow'.format(key)), os.path.join(self.cache_dir, '{}.json'.format(key))
+
+    def _remove(self, key):
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key, get_modified=None):
+        """
+        :param key: cache key from get_key
+        :param get_modified: function returning the last modified time of a table name, used with validate_tables
+        :return: pyarrow Table memory mapped from the cache, None on misses
+        """
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError):
+            self._count(hit=False)
+            return None
+
+        expired = self.ttl is not None and time.time() - meta['created'] > self.ttl
+        if not expired and self.validate_tables and get_modified is not None:
+            expired = any(get_modified(table) != modified for table, modified in meta['referenced_tables'].items())
+        if expired:
+            self._remove(key)
+            self._count(hit=False)
+            return None
+
+        try:
+            table = pa.ipc.open_file(pa.memory_map(data_path, 'r')).read_all()
+        except (OSError, pa.ArrowInvalid):
+            self._remove(key)
+            self._count(hit=False)
+            return None
+        os.utime(data_path)
+        self._count(hit=True)
+        return table
+
+    def put(self, key, table, referenced_tables=None):
+        """
+        :param key: cache key from get_key
+        :param table: pyarrow Table to cache
+        :param referenced_tables: dict of {table name: last modified time} of the tables read by the query
+        """
+        data_path, meta_path = self._paths(key)
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp-')
+        os.close(fd)
+        try:
+            with pa.OSFile(temp_path, 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(temp_path, data_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        _atomic_write(meta_path, json.dumps({'created': time.time(), 'referenced_tables': referenced_tables or {}}))
+        self.evict()
+
+    def evict(self):
+        """
+        Removes expired results, then the least recently used ones until the cache fits in max_bytes.
+        """
+        entries = []
+        for data_path in glob.glob(os.path.join(self.cache_dir, '*.arrow')):
+            try:
+                stat = os.stat(data_path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, os.path.basename(data_path)[:-len('.arrow')]))
+        entries.sort()
+        total_bytes = sum(size for _, size, _ in entries)
+        for last_used, size, key in entries:
+            if total_bytes <= self.max_bytes and (self.ttl is None or time.time() - last_used <= self.ttl):
+                continue
+            self._remove(key)
+            total_bytes -= size
+
+    def info(self):
+        """
+        :return: dict of cache counters
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+class JsonStateStore:
+    """
+    Key value store persisted as a json file, used to keep watermarks between runs.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: json file path, created on first set
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, key, default=None):
+        """
+        :param key: state key
+        :param default: value returned when key is missing
+        :return: stored value
+        """
+        with self._lock:
+            return self._load().get(key, default)
+
+    def set(self, key, value):
+        """
+        :param key: state key
+        :param value: json serializable value
+        """
+        with self._lock:
+            state = self._load()
+            state[key] = value
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            _atomic_write(os.path.abspath(self.path), json.dumps(state, indent=2, sort_keys=True))
+
+
+class BlobCache:
+    """
+    Read-through on-disk cache of GCS blobs keyed by bucket, name and generation. A cached file is reused while
+    its generation and md5 (crc32c for composite objects) match the blob metadata, so a repeat read costs a
+    metadata call instead of a download. Downloads hold a file lock, so concurrent processes sharing cache_dir
+    download each blob once. Files are evicted least recently used first when the cache grows over max_bytes,
+    under the same lock, so a file opened with open or open_cached is never removed before it is opened.
+    """
+
+    def __init__(self, cache_dir, max_bytes=10 * 1024 ** 3, lock_timeout=600):
+        """
+        :param cache_dir: directory where blobs are stored
+        :param max_bytes: max total size of the cached files
+        :param lock_timeout: seconds to wait for another process downloading the same blob
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock_timeout = lock_timeout
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _name_key(bucket_name, blob_name):
+        return hashlib.sha1('{}/{}'.format(bucket_name, blob_name).encode('utf-8')).hexdigest()
+
+    def _paths(self, bucket_name, blob_name, generation):
+        base = os.path.join(self.cache_dir, '{}-{}'.format(self._name_key(bucket_name, blob_name), generation))
+        return base + '.blob', base + '.json'
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @staticmethod
+    def _is_valid(data_path, meta_path, blob):
+        try:
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            size = os.path.getsize(data_path)
+        except (OSError, ValueError):
+            return False
+        if size != meta['size']:
+            return False
+        if blob.md5_hash is not None:
+            return meta['md5_hash'] == blob.md5_hash
+        return meta['crc32c'] == blob.crc32c
+
+    def _find(self, bucket_name, blob_name):
+        pattern = os.path.join(self.cache_dir, '{}-*.blob'.format(self._name_key(bucket_name, blob_name)))
+        paths = []
+        for data_path in glob.glob(pattern):
+            try:
+                paths.append((os.stat(data_path).st_mtime, data_path))
+            except OSError:
+                continue
+        return max(paths)[1] if paths else None
+
+    def lookup(self, bucket_name, blob_name):
+        """
+        :param bucket_name: GCS bucket name
+        :param blob_name: blob name
+        :return: path of the most recently used cached generation of the blob, None if not cached
+        """
+        data_path = self._find(bucket_name, blob_name)
+        if data_path is None:
+            self._count(hit=False)
+            return None
+        os.utime(data_path)
+        self._count(hit=True)
+        return data_path
+
+    def open_cached(self, bucket_name, blob_name):
+        """
+        Like lookup, but the file is opened under its lock so it cannot be evicted in between.
+
+        :param bucket_name: GCS bucket name
+        :param blob_name: blob name
+        :return: binary file object of the most recently used cached generation of the blob, None if not cached
+        """
+        data_path = self._find(bucket_name, blob_name)
+        if data_path is not None:
+            with LockFile(data_path, timeout=self.lock_timeout):
+                try:
+                    local_file = open(data_path, 'rb')
+                except OSError:
+                    # evicted while waiting for the lock
+                    local_file = None
+            if local_file is not None:
+                os.utime(data_path)
+                self._count(hit=True)
+                return local_file
+        self._count(hit=False)
+        return None
+
+    def _fetch(self, blob, data_path, meta_path):
+        # the caller holds the lock of data_path
+        if self._is_valid(data_path, meta_path, blob):
+            os.utime(data_path)
+            self._count(hit=True)
+            return
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp-')
+        os.close(fd)
+        try:
+            blob.download_to_filename(temp_path)
+            os.replace(temp_path, data_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        _atomic_write(meta_path, json.dumps({'bucket': blob.bucket.name, 'name': blob.name,
+                                             'generation': blob.generation, 'size': os.path.getsize(data_path),
+                                             'md5_hash': blob.md5_hash, 'crc32c': blob.crc32c}))
+        self._count(hit=False)
+
+    def get(self, blob):
+        """
+        The returned path can be evicted by another reader once this call returns, use open to read it safely.
+
+        :param blob: GCS blob with loaded metadata, e.g. from bucket.get_blob
+        :return: path of the local copy of the blob, downloaded if missing or stale
+        """
+        data_path, meta_path = self._paths(blob.bucket.name, blob.name, blob.generation)
+        if self._is_valid(data_path, meta_path, blob):
+            os.utime(data_path)
+            self._count(hit=True)
+            return data_path
+
+        with LockFile(data_path, timeout=self.lock_timeout):
+            self._fetch(blob, data_path, meta_path)
+
+        self._remove_other_generations(blob)
+        self.evict(keep=data_path)
+        return data_path
+
+    def open(self, blob):
+        """
+        Like get, but the file is opened under its lock: an open file stays readable after its entry is evicted.
+
+        :param blob: GCS blob with loaded metadata, e.g. from bucket.get_blob
+        :return: binary file object of the local copy of the blob, downloaded if missing or stale
+        """
+        data_path, meta_path = self._paths(blob.bucket.name, blob.name, blob.generation)
+        with LockFile(data_path, timeout=self.lock_timeout):
+            self._fetch(blob, data_path, meta_path)
+            local_file = open(data_path, 'rb')
+
+        self._remove_other_generations(blob)
+        self.evict(keep=data_path)
+        return local_file
+
+    def _remove_entry(self, data_path):
+        """
+        :return: whether the entry was removed, False while another thread or process holds its lock
+        """
+        lock = LockFile(data_path, timeout=0)
+        try:
+            lock.acquire()
+        except LockError:
+            return False
+        try:
+            for path in (data_path, data_path[:-len('.blob')] + '.json'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        finally:
+            lock.release()
+        return True
+
+    def _remove_other_generations(self, blob):
+        current_path = self._paths(blob.bucket.name, blob.name, blob.generation)[0]
+        pattern = os.path.join(self.cache_dir, '{}-*.blob'.format(self._name_key(blob.bucket.name, blob.name)))
+        for data_path in glob.glob(pattern):
+            if data_path != current_path:
+                self._remove_entry(data_path)
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used blobs until the cache fits in max_bytes, skipping the ones being downloaded
+        or opened.
+
+        :param keep: path of a cached blob never removed, like the one just downloaded even if over max_bytes
+        """
+        entries = []
+        for data_path in glob.glob(os.path.join(self.cache_dir, '*.blob')):
+            try:
+                stat = os.stat(data_path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, data_path))
+        entries.sort()
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, data_path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            if data_path != keep and self._remove_entry(data_path):
+                total_bytes -= size
+
+    def info(self):
+        """
+        :return: dict of cache counters
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+def get_shared_schema_cache():
+    """
+    :return: process-wide SchemaCache shared by every connector created with schema_cache=True
+    """
+    global _shared_schema_cache
+    with _shared_schema_cache_lock:
+        if _shared_schema_cache is None:
+            _shared_schema_cache = SchemaCache()
+        return _shared_schema_cache
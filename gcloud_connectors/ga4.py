@@ -1,12 +1,23 @@
+import datetime
+import random
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 import google.auth
+from google.api_core.exceptions import ResourceExhausted
+import numpy as np
 import pandas as pd
 from google.analytics.data_v1beta import BetaAnalyticsDataClient
+from google.analytics.data_v1beta.types import BatchRunReportsRequest
 from google.analytics.data_v1beta.types import DateRange
 from google.analytics.data_v1beta.types import Dimension
 from google.analytics.data_v1beta.types import Filter
 from google.analytics.data_v1beta.types import FilterExpression
 from google.analytics.data_v1beta.types import FilterExpressionList
 from google.analytics.data_v1beta.types import Metric
+from google.analytics.data_v1beta.types import MetricType
 from google.analytics.data_v1beta.types import RunReportRequest
 from google.oauth2 import service_account
 
@@ -14,9 +25,246 @@ from gcloud_connectors.logger import EmptyLogger
 
 SCOPES = ['https://www.googleapis.com/auth/analytics']
 
+# max number of reports in a batchRunReports request
+_MAX_BATCH_REPORTS = 5
+
+_DAYS_AGO = re.compile(r'^(\d+)daysAgo$')
+_SHARD_DAYS = {'day': 1, 'week': 7}
+
+
+def _resolve_date(value, today=None):
+    """
+    :param value: GA4 date, like 2024-01-31, today, yesterday or 7daysAgo
+    :param today: date used for relative values, default the local current date
+    :return: datetime.date
+    """
+    if isinstance(value, datetime.date):
+        return value
+    today = today or datetime.date.today()
+    if value == 'today':
+        return today
+    if value == 'yesterday':
+        return today - datetime.timedelta(days=1)
+    days_ago = _DAYS_AGO.match(value)
+    if days_ago:
+        return today - datetime.timedelta(days=int(days_ago.group(1)))
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def _split_date_range(start_date, end_date, days):
+    """
+    :return: list of (start date, end date) of consecutive ranges of days days covering start_date to end_date
+    """
+    ranges = []
+    while start_date <= end_date:
+        shard_end = min(start_date + datetime.timedelta(days=days - 1), end_date)
+        ranges.append((start_date, shard_end))
+        start_date = shard_end + datetime.timedelta(days=1)
+    return ranges
+
+# every metric type other than integers and unspecified is a float value, e.g. seconds or currency amounts
+_INTEGER_METRIC_TYPES = {MetricType.TYPE_INTEGER}
+_STRING_METRIC_TYPES = {MetricType.METRIC_TYPE_UNSPECIFIED}
+
+
+class GA4QuotaError(Exception):
+    """Raised when the daily tokens left to a property are not enough for another request"""
+    pass
+
+
+class _PropertyQuotaState:
+    def __init__(self, max_concurrent, tokens_per_hour, initial_cost, initial_delay):
+        self.limit = float(max_concurrent)
+        self.active = 0
+        self.level = float(tokens_per_hour) if tokens_per_hour is not None else None
+        self.updated = time.monotonic()
+        self.cost = float(initial_cost)
+        self.daily_remaining = None
+        self.daily_updated = None
+        self.concurrent_cap = None
+        self.property_quota = None
+        self.blocked_until = 0.0
+        self.delay = initial_delay
+
+
+class PropertyQuotaScheduler:
+    """
+    Throttles GA4 requests per property before the API answers 429. Each property has a token bucket refilled at
+    tokens_per_hour / 3600 tokens per second, synced with the tokens_per_hour remaining in the property_quota of
+    every response and charged with the average tokens consumed by a request. Concurrency is capped by
+    max_concurrent and by the concurrent requests the last property_quota left available, and adapted like TCP
+    congestion control: every ResourceExhausted error halves it and pauses the property with exponential backoff
+    and jitter, every success raises it back slowly. Once the daily tokens run out requests raise GA4QuotaError,
+    until daily_quota_ttl seconds later a request is let through to read the quota again.
+    """
+
+    def __init__(self, max_concurrent=10, tokens_per_hour=40000, initial_cost=10, max_retries=5, initial_delay=1,
+                 max_delay=60, jitter=0.1, daily_quota_ttl=3600, logger=None):
+        """
+        :param max_concurrent: max requests in flight per property, 10 for standard properties
+        :param tokens_per_hour: hourly tokens of a property, 40000 for standard properties, None to throttle only
+                                on errors
+        :param initial_cost: tokens charged to a request before responses reveal the real cost
+        :param max_retries: retries of a request failing with ResourceExhausted
+        :param initial_delay: seconds of the first pause after a ResourceExhausted error
+        :param max_delay: max seconds of a pause
+        :param jitter: random fraction added or removed from every pause
+        :param daily_quota_ttl: seconds after which exhausted daily tokens are checked again with a request
+        :param logger: logger, default does not log
+        """
+        self.max_concurrent = max_concurrent
+        self.tokens_per_hour = tokens_per_hour
+        self.initial_cost = initial_cost
+        self.max_retries = max_retries
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.daily_quota_ttl = daily_quota_ttl
+        self.logger = logger if logger is not None else EmptyLogger()
+        self._states = {}
+        self._condition = threading.Condition()
+
+    def _get_state(self, property_key):
+        if property_key not in self._states:
+            self._states[property_key] = _PropertyQuotaState(self.max_concurrent, self.tokens_per_hour,
+                                                             self.initial_cost, self.initial_delay)
+        return self._states[property_key]
+
+    def _refill(self, state, now):
+        if state.level is not None and self.tokens_per_hour is not None:
+            state.level = min(float(self.tokens_per_hour),
+                              state.level + (now - state.updated) * self.tokens_per_hour / 3600.0)
+        state.updated = now
+
+    def acquire(self, property_key):
+        """
+        Blocks until the property has a free concurrency slot and enough tokens for a request.
+
+        :param property_key: property name, like properties/1234
+        """
+        with self._condition:
+            state = self._get_state(property_key)
+            while True:
+                now = time.monotonic()
+                if state.daily_remaining is not None and state.daily_remaining < state.cost:
+                    if now - state.daily_updated < self.daily_quota_ttl:
+                        raise GA4QuotaError('{} has {} daily tokens left'.format(property_key,
+                                                                                state.daily_remaining))
+                    # the daily quota may have been reset since, the next response tells
+                    state.daily_remaining = None
+                self._refill(state, now)
+                waits = []
+                if now < state.blocked_until:
+                    waits.append(state.blocked_until - now)
+                if state.level is not None and state.level < state.cost:
+                    waits.append((state.cost - state.level) * 3600.0 / self.tokens_per_hour)
+                if not waits and state.active < int(state.limit):
+                    state.active += 1
+                    if state.level is not None:
+                        state.level -= state.cost
+                    return
+                wait = max(waits) if waits else None
+                if wait is not None and wait > 1:
+                    self.logger.info('throttling {} for {:.1f}s'.format(property_key, wait))
+                self._condition.wait(timeout=wait)
+
+    def release(self, property_key, quotas=None, throttled=False):
+        """
+        :param property_key: property name, like properties/1234
+        :param quotas: list of PropertyQuota of the response, empty when the request failed
+        :param throttled: whether the request failed with ResourceExhausted
+        """
+        with self._condition:
+            state = self._get_state(property_key)
+            state.active -= 1
+            now = time.monotonic()
+            if throttled:
+                state.limit = max(1.0, state.limit / 2)
+                if state.level is not None:
+                    state.level = 0.0
+                pause = state.delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+                state.blocked_until = max(state.blocked_until, now + pause)
+                state.delay = min(state.delay * 2, self.max_delay)
+                self.logger.warning('{} throttled by GA4, pausing {:.1f}s with {} concurrent requests'.format(
+                    property_key, pause, int(state.limit)))
+            else:
+                state.delay = self.initial_delay
+                concurrent = [quota.concurrent_requests for quota in quotas or [] if
+                              quota.concurrent_requests.remaining or quota.concurrent_requests.consumed]
+                if concurrent:
+                    # slots left to other clients of the property are not available to this process
+                    state.concurrent_cap = max(1, state.active + 1 + min(status.remaining for status in concurrent))
+                max_limit = float(self.max_concurrent if state.concurrent_cap is None else
+                                  min(self.max_concurrent, state.concurrent_cap))
+                state.limit = min(max_limit, state.limit + 1 / state.limit)
+                quotas = [quota for quota in quotas or [] if quota.tokens_per_hour.remaining or
+                          quota.tokens_per_hour.consumed]
+                if quotas:
+                    state.property_quota = quotas[-1]
+                    consumed = sum(quota.tokens_per_hour.consumed for quota in quotas)
+                    state.cost = 0.8 * state.cost + 0.2 * consumed
+                    if self.tokens_per_hour is not None:
+                        # tokens of the requests still in flight are not counted by the last response yet
+                        state.level = min(float(self.tokens_per_hour),
+                                          quotas[-1].tokens_per_hour.remaining - state.active * state.cost)
+                        state.updated = now
+                    daily = [quota.tokens_per_day for quota in quotas if quota.tokens_per_day.remaining or
+                             quota.tokens_per_day.consumed]
+                    if daily:
+                        state.daily_remaining = min(status.remaining for status in daily)
+                        state.daily_updated = now
+            self._condition.notify_all()
+
+    @staticmethod
+    def _get_quotas(response):
+        reports = response.reports if hasattr(response, 'reports') else [response]
+        return [report.property_quota for report in reports if report.property_quota]
+
+    def call(self, property_key, func, request):
+        """
+        :param property_key: property name, like properties/1234
+        :param func: API method, like BetaAnalyticsDataClient.run_report
+        :param request: request passed to func
+        :return: func response
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire(property_key)
+            try:
+                response = func(request)
+            except ResourceExhausted:
+                self.release(property_key, throttled=True)
+                if attempt == self.max_retries:
+                    raise
+                continue
+            except BaseException:
+                self.release(property_key)
+                raise
+            self.release(property_key, quotas=self._get_quotas(response))
+            return response
+
+    def info(self, property_key):
+        """
+        :param property_key: property name, like properties/1234
+        :return: dict of the scheduler state of the property
+        """
+        with self._condition:
+            state = self._get_state(property_key)
+            return {'concurrency_limit': int(state.limit), 'active': state.active, 'tokens': state.level,
+                    'cost': state.cost, 'daily_remaining': state.daily_remaining,
+                    'property_quota': state.property_quota}
+
 
 class GAnalytics4Connector:
-    def __init__(self, confs_path=None, auth_type='service_account', json_keyfile_dict=None, logger=None):
+    def __init__(self, confs_path=None, auth_type='service_account', json_keyfile_dict=None, logger=None,
+                 quota_scheduler=None):
+        """
+        :param confs_path: path of the service account json keyfile
+        :param auth_type: authentication type
+        :param json_keyfile_dict: service account json keyfile as dict
+        :param logger: logger, default does not log
+        :param quota_scheduler: PropertyQuotaScheduler shared by every request, default one per connector,
+                                False to send requests without throttling
+        """
         self.confs_path = confs_path
         self.json_keyfile_dict = json_keyfile_dict
         self.auth_type = auth_type
@@ -37,6 +285,10 @@ class GAnalytics4Connector:
 
         self.logger = logger if logger is not None else EmptyLogger()
         self.service = BetaAnalyticsDataClient(credentials=self.creds)
+        if quota_scheduler is None:
+            quota_scheduler = PropertyQuotaScheduler(logger=self.logger)
+        self.quota_scheduler = quota_scheduler or None
+        self.property_quotas = {}
 
     @staticmethod
     def get_base_report_params(property_id, metrics_dict_values, dimensions_dict_values, date_range, limit, offset,
@@ -111,21 +363,53 @@ class GAnalytics4Connector:
         return filter_dict_values
 
     @staticmethod
-    def get_df_from_response(response, dimensions, metrics):
-        output = []
-        for row in response.rows:
-            current_row = {}
-            for dim in dimensions:
-                current_row[dim] = row.dimension_values[dimensions.index(dim)].value
-            for metr in metrics:
-                current_row[metr] = row.metric_values[metrics.index(metr)].value
-            output.append(current_row)
-        return pd.DataFrame(output)
+    def _cast_metric(values, metric_type):
+        if metric_type in _STRING_METRIC_TYPES:
+            return values
+        dtype = np.int64 if metric_type in _INTEGER_METRIC_TYPES else np.float64
+        try:
+            return values.astype(dtype)
+        except (ValueError, OverflowError):
+            return pd.to_numeric(values, errors='coerce')
 
-    def pd_get_report(self, property_id, start_date, end_date, metrics, dimensions, dimension_filters=None,
-                      metrics_filters=None, offset=0, limit=100000,
-                      keep_empty_rows=False, return_property_quota=False, downloaded_totals=0, cast_date_column=None, or_dimension_filters=None):
-        """Runs a complex report on a Google Analytics 4 property."""
+    @staticmethod
+    def get_df_from_response(response, dimensions, metrics, categorical_dimensions=True):
+        """
+        Decodes the report rows in a single pass into per-column arrays. Metrics are casted to int64 or float64
+        from the response metric_headers types, dimensions are strings or categoricals.
+
+        :param response: RunReportResponse
+        :param dimensions: list of dimension names
+        :param metrics: list of metric names
+        :param categorical_dimensions: whether to return dimensions as pandas categoricals
+        :return: pandas DataFrame with dimensions and metrics columns
+        """
+        # raw protobuf rows avoid the proto-plus wrapper built on every field access
+        rows = type(response).pb(response).rows
+        num_rows = len(rows)
+        dimension_values = [np.empty(num_rows, dtype=object) for _ in dimensions]
+        metric_values = [np.empty(num_rows, dtype=object) for _ in metrics]
+        for i, row in enumerate(rows):
+            for values, value in zip(dimension_values, row.dimension_values):
+                values[i] = value.value
+            for values, value in zip(metric_values, row.metric_values):
+                values[i] = value.value
+
+        metric_types = {header.name: header.type_ for header in response.metric_headers}
+        data = {}
+        for dim, values in zip(dimensions, dimension_values):
+            data[dim] = pd.Categorical(values) if categorical_dimensions else values
+        for metr, values in zip(metrics, metric_values):
+            data[metr] = GAnalytics4Connector._cast_metric(
+                values, metric_types.get(metr, MetricType.METRIC_TYPE_UNSPECIFIED))
+        return pd.DataFrame(data, columns=list(dimensions) + list(metrics))
+
+    def get_report_params(self, property_id, start_date, end_date, metrics, dimensions, dimension_filters=None,
+                          metrics_filters=None, offset=0, limit=100000, keep_empty_rows=False,
+                          return_property_quota=False, or_dimension_filters=None):
+        """
+        :return: dict of RunReportRequest params, see pd_get_report
+        """
         dimensions_dict_values = [Dimension({"name": x}) for x in dimensions]
         metrics_dict_values = [Metric({"name": x}) for x in metrics]
         date_range = [DateRange({"start_date": start_date, "end_date": end_date})]
@@ -141,12 +425,13 @@ class GAnalytics4Connector:
         metric_filter_dict_values = self.get_filters(metrics_filters)
         or_dimension_filters_values = self.get_filters(or_dimension_filters)
 
-
         report_params = self.get_base_report_params(property_id=property_id, metrics_dict_values=metrics_dict_values,
                                                     dimensions_dict_values=dimensions_dict_values,
                                                     date_range=date_range, limit=limit, offset=offset,
                                                     keep_empty_rows=keep_empty_rows,
-                                                    return_property_quota=return_property_quota)
+                                                    # the quota scheduler needs property_quota in every response
+                                                    return_property_quota=return_property_quota or
+                                                    self.quota_scheduler is not None)
         if len(dimension_filter_dict_values):
             if len(or_dimension_filters_values):
                 report_params["dimension_filter"] = FilterExpression({
@@ -181,30 +466,253 @@ class GAnalytics4Connector:
                     }
                 )
             })
+        return report_params
+
+    def _call(self, property_key, func, request):
+        if self.quota_scheduler is not None:
+            response = self.quota_scheduler.call(property_key, func, request)
+        else:
+            response = func(request)
+        for report in (response.reports if hasattr(response, 'reports') else [response]):
+            if report.property_quota:
+                self.property_quotas[property_key] = report.property_quota
+        return response
 
-        request = RunReportRequest(report_params)
+    def _run_report(self, report_params, offset):
+        request = RunReportRequest(dict(report_params, offset=offset))
+        return self._call(report_params["property"], self.service.run_report, request)
 
-        response = self.service.run_report(request)
+    @staticmethod
+    def _get_page_offsets(report_params, response):
+        """
+        :param report_params: dict of RunReportRequest params, see get_report_params
+        :param response: RunReportResponse of the first page
+        :return: list of the offsets of the pages missing from response
+        """
+        offset = report_params["offset"]
+        limit = report_params["limit"]
+        if len(response.rows) >= response.row_count:
+            return []
+        return list(range(offset + limit, response.row_count, limit))
 
-        df = self.get_df_from_response(response, dimensions, metrics)
+    def _get_page_df(self, report_params, page_offset, dimensions, metrics):
+        return self.get_df_from_response(self._run_report(report_params, page_offset), dimensions, metrics,
+                                         categorical_dimensions=False)
+
+    def _get_report_frames(self, report_params, response, dimensions, metrics, max_workers):
+        """
+        :param report_params: dict of RunReportRequest params, see get_report_params
+        :param response: RunReportResponse of the first page
+        :return: list of DataFrames of every page, the remaining pages are fetched concurrently
+        """
+        frames = [self.get_df_from_response(response, dimensions, metrics, categorical_dimensions=False)]
 
         # if missing pages for all rows in response.row_count
-        if len(response.rows) < response.row_count and downloaded_totals < response.row_count:
-            downloaded_totals = len(response.rows) + downloaded_totals
-            print(
-                "Recursive iteration page {current_page}/{pages} for records {records}/{totals}".format(
-                    records=offset + limit if offset + limit < response.row_count else response.row_count,
-                    totals=response.row_count,
-                    current_page=round(downloaded_totals / limit),
-                    pages=round(response.row_count / limit)
-                ))
-            df = df.append(
-                self.pd_get_report(property_id=property_id, start_date=start_date, end_date=end_date, metrics=metrics,
-                                   dimensions=dimensions, dimension_filters=dimension_filters,
-                                   metrics_filters=metrics_filters, offset=offset + limit, limit=limit,
-                                   keep_empty_rows=keep_empty_rows, return_property_quota=return_property_quota,
-                                   downloaded_totals=downloaded_totals))
+        offsets = self._get_page_offsets(report_params, response)
+        if offsets:
+            self.logger.info('fetching {pages} more pages for {totals} records'.format(pages=len(offsets),
+                                                                                      totals=response.row_count))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                pages = executor.map(
+                    lambda page_offset: self._get_page_df(report_params, page_offset, dimensions, metrics), offsets)
+                for current_page, page_df in enumerate(pages, 2):
+                    frames.append(page_df)
+                    self.logger.info('page {current_page}/{pages}'.format(current_page=current_page,
+                                                                          pages=len(offsets) + 1))
+        return frames
+
+    @staticmethod
+    def _concat_report_frames(frames, dimensions, cast_date_column=None, categorical_dimensions=True):
+        df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+        # categories are built once on the whole report, concatenating categorical pages would fall back to object
+        if categorical_dimensions:
+            for dim in dimensions:
+                df[dim] = df[dim].astype('category')
+
         if cast_date_column:
             if 'date' in df.columns:
                 df['date'] = pd.to_datetime(df['date'], format="%Y%m%d").dt.date
         return df
+
+    def pd_get_report(self, property_id, start_date, end_date, metrics, dimensions, dimension_filters=None,
+                      metrics_filters=None, offset=0, limit=100000,
+                      keep_empty_rows=False, return_property_quota=False, downloaded_totals=0, cast_date_column=None,
+                      or_dimension_filters=None, max_workers=4, categorical_dimensions=True, shard_by=None,
+                      shard_row_threshold=100000):
+        """
+        Runs a complex report on a Google Analytics 4 property. The first page reveals the report row_count, then
+        the remaining pages are fetched concurrently and concatenated once.
+
+        With shard_by the date range is split into shards run concurrently and merged, to extract long ranges
+        below GA4 row limits and (other) row grouping. Shards are concatenated, so add the date dimension to
+        reports whose rows would otherwise repeat across shards.
+
+        :param max_workers: number of pages, or shards, requested in parallel, keep it below the property concurrent
+                            requests quota
+        :param categorical_dimensions: whether to return dimensions as pandas categoricals
+        :param shard_by: None, 'day' or 'week' to split the date range in shards of fixed length, 'auto' to bisect
+                         the range while a shard has more than shard_row_threshold rows or data loss from the
+                         (other) row
+        :param shard_row_threshold: max rows of a shard with shard_by='auto'
+        :param return_property_quota: whether to request the property quota, always requested when the connector
+                                      has a quota_scheduler. The last quota of each property is kept in
+                                      property_quotas
+        :param downloaded_totals: deprecated, ignored
+        """
+        if shard_by is not None:
+            frames = self._get_sharded_report_frames(
+                shard_by, shard_row_threshold, max_workers, property_id=property_id, start_date=start_date,
+                end_date=end_date, metrics=metrics, dimensions=dimensions, dimension_filters=dimension_filters,
+                metrics_filters=metrics_filters, offset=offset, limit=limit, keep_empty_rows=keep_empty_rows,
+                or_dimension_filters=or_dimension_filters)
+            return self._concat_report_frames(frames, dimensions, cast_date_column=cast_date_column,
+                                              categorical_dimensions=categorical_dimensions)
+
+        report_params = self.get_report_params(property_id=property_id, start_date=start_date, end_date=end_date,
+                                               metrics=metrics, dimensions=dimensions,
+                                               dimension_filters=dimension_filters, metrics_filters=metrics_filters,
+                                               offset=offset, limit=limit, keep_empty_rows=keep_empty_rows,
+                                               return_property_quota=return_property_quota,
+                                               or_dimension_filters=or_dimension_filters)
+
+        response = self._run_report(report_params, offset)
+        frames = self._get_report_frames(report_params, response, dimensions, metrics, max_workers)
+        return self._concat_report_frames(frames, dimensions, cast_date_column=cast_date_column,
+                                          categorical_dimensions=categorical_dimensions)
+
+    def _get_shard_first_page(self, start_date, end_date, bisect_rows, **report_kwargs):
+        """
+        :param bisect_rows: row count over which a shard of more than one day is split, None to never split
+        :return: tuple of (report_params, RunReportResponse of the first page, None) or (None, None, list of the two
+                 halves of the date range)
+        """
+        report_params = self.get_report_params(start_date=start_date.isoformat(), end_date=end_date.isoformat(),
+                                               **report_kwargs)
+        if bisect_rows is not None and start_date < end_date:
+            # a one row probe reveals the row count without downloading a page that would be thrown away
+            probe = self._run_report(dict(report_params, limit=1), report_params["offset"])
+            if probe.row_count > bisect_rows or probe.metadata.data_loss_from_other_row:
+                middle = start_date + (end_date - start_date) // 2
+                self.logger.info('splitting {} - {} with {} rows'.format(start_date, end_date, probe.row_count))
+                return None, None, [(start_date, middle), (middle + datetime.timedelta(days=1), end_date)]
+        return report_params, self._run_report(report_params, report_params["offset"]), None
+
+    def _get_sharded_report_frames(self, shard_by, shard_row_threshold, max_workers, start_date, end_date,
+                                   **report_kwargs):
+        """
+        :return: list of DataFrames of every shard, sorted by date range
+        """
+        start_date, end_date = _resolve_date(start_date), _resolve_date(end_date)
+        if shard_by == 'auto':
+            ranges, bisect_rows = [(start_date, end_date)], shard_row_threshold
+        elif shard_by in _SHARD_DAYS:
+            ranges, bisect_rows = _split_date_range(start_date, end_date, _SHARD_DAYS[shard_by]), None
+        else:
+            raise ValueError("shard_by must be None, 'day', 'week' or 'auto', got {}".format(shard_by))
+        dimensions = report_kwargs["dimensions"]
+        metrics = report_kwargs["metrics"]
+
+        shard_frames = {}
+        # shards and their remaining pages share the pool, so at most max_workers requests are in flight
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = {executor.submit(self._get_shard_first_page, shard_start, shard_end, bisect_rows,
+                                       **report_kwargs): ((shard_start, shard_end), None)
+                       for shard_start, shard_end in ranges}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    date_range, page = pending.pop(future)
+                    if page is not None:
+                        shard_frames[date_range][page] = future.result()
+                        continue
+                    report_params, response, halves = future.result()
+                    if halves is not None:
+                        for shard_start, shard_end in halves:
+                            pending[executor.submit(self._get_shard_first_page, shard_start, shard_end, bisect_rows,
+                                                    **report_kwargs)] = ((shard_start, shard_end), None)
+                        continue
+                    offsets = self._get_page_offsets(report_params, response)
+                    shard_frames[date_range] = [self.get_df_from_response(response, dimensions, metrics,
+                                                                           categorical_dimensions=False)]
+                    shard_frames[date_range].extend([None] * len(offsets))
+                    for page, page_offset in enumerate(offsets, 1):
+                        pending[executor.submit(self._get_page_df, report_params, page_offset, dimensions,
+                                                metrics)] = (date_range, page)
+        self.logger.info('merging {} shards from {} to {}'.format(len(shard_frames), start_date, end_date))
+        return [frame for date_range in sorted(shard_frames) for frame in shard_frames[date_range]]
+
+    def _run_batch(self, property_id, batch):
+        """
+        :param batch: list of report tuples of the same property, at most 5, whose second item is the report_params
+        :return: list of the report tuples extended with the RunReportResponse of their first page
+        """
+        request = BatchRunReportsRequest({
+            "property": "properties/{property_id}".format(property_id=property_id),
+            "requests": [RunReportRequest(report[1]) for report in batch]
+        })
+        response = self._call(request.property, self.service.batch_run_reports, request)
+        return [report + (response_report,) for report, response_report in zip(batch, response.reports)]
+
+    def pd_get_reports(self, requests, max_workers=4, categorical_dimensions=True):
+        """
+        Runs many reports with batchRunReports calls of up to 5 reports of the same property, the batches run
+        concurrently. Reports with more rows than the first page are then completed with run_report pages, in
+        the same pool, so at most max_workers requests are in flight. Reports with shard_by cannot be batched,
+        they run one after the other with pd_get_report once the batches are done.
+
+        requests = {"sessions_by_country": {"property_id": 123, "start_date": "2024-01-01", "end_date": "today",
+        "metrics": ["sessions"], "dimensions": ["country"], "cast_date_column": True}}
+
+        :param requests: dict of {report name: dict of pd_get_report params}, a report max_workers is ignored and
+                         its categorical_dimensions overrides the one of the call
+        :param max_workers: number of batches, then pages, requested in parallel
+        :param categorical_dimensions: whether to return dimensions as pandas categoricals
+        :return: dict of {report name: DataFrame}
+        """
+        batches = []
+        by_property = {}
+        sharded = {}
+        for name, params in requests.items():
+            params = dict(params)
+            cast_date_column = params.pop("cast_date_column", None)
+            report_categorical = params.pop("categorical_dimensions", categorical_dimensions)
+            params.pop("max_workers", None)
+            params.pop("downloaded_totals", None)
+            if params.get("shard_by") is not None:
+                sharded[name] = dict(params, cast_date_column=cast_date_column,
+                                     categorical_dimensions=report_categorical)
+                continue
+            params.pop("shard_by", None)
+            params.pop("shard_row_threshold", None)
+            report_params = self.get_report_params(**params)
+            by_property.setdefault(params["property_id"], []).append(
+                (name, report_params, cast_date_column, report_categorical))
+        for property_id, reports in by_property.items():
+            for i in range(0, len(reports), _MAX_BATCH_REPORTS):
+                batches.append((property_id, reports[i:i + _MAX_BATCH_REPORTS]))
+        self.logger.info('running {reports} reports in {batches} batches'.format(reports=len(requests) - len(sharded),
+                                                                                 batches=len(batches)))
+
+        dfs = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            reports = [report for results in executor.map(lambda item: self._run_batch(*item), batches)
+                       for report in results]
+            pages = []
+            for name, report_params, _, _, response in reports:
+                dimensions = [dimension.name for dimension in report_params["dimensions"]]
+                metrics = [metric.name for metric in report_params["metrics"]]
+                pages.append([executor.submit(self._get_page_df, report_params, page_offset, dimensions, metrics)
+                              for page_offset in self._get_page_offsets(report_params, response)])
+            self.logger.info('fetching {pages} more pages'.format(pages=sum(len(futures) for futures in pages)))
+
+            for (name, report_params, cast_date_column, report_categorical, response), futures in zip(reports, pages):
+                dimensions = [dimension.name for dimension in report_params["dimensions"]]
+                metrics = [metric.name for metric in report_params["metrics"]]
+                frames = [self.get_df_from_response(response, dimensions, metrics, categorical_dimensions=False)]
+                frames.extend(future.result() for future in futures)
+                dfs[name] = self._concat_report_frames(frames, dimensions, cast_date_column=cast_date_column,
+                                                       categorical_dimensions=report_categorical)
+
+        for name, params in sharded.items():
+            dfs[name] = self.pd_get_report(max_workers=max_workers, **params)
+        return {name: dfs[name] for name in requests}
@@ -1,20 +1,359 @@
+import base64
 import json
+import mmap
+import operator
 import os
+import posixpath
+import queue
 import socket
+import threading
 import tempfile
+import uuid
+from collections import namedtuple
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from itertools import chain
+from itertools import islice
+from urllib.parse import unquote
 from operator import itemgetter
 
 import google
+import google_crc32c
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import requests
 import urllib3
 from google.cloud import storage
 from retry import retry
 
 from gcloud_connectors.logger import EmptyLogger
+from gcloud_connectors.pa_utils import iter_arrow_tables
+from gcloud_connectors.pa_utils import to_arrow_table
+
+_HIVE_NULL = '__HIVE_DEFAULT_PARTITION__'
+_MAX_COMPOSE_SOURCES = 32
+_SHARD_DONE = object()
+_DISCOVERY_DONE = object()
+
+BlobFailure = namedtuple('BlobFailure', ['name', 'error'])
+
+
+class BlobOperationError(Exception):
+    """Raised when some blobs of a bulk operation failed, report is the BlobOperationReport of the operation"""
+
+    def __init__(self, message, report):
+        super().__init__(message)
+        self.report = report
+
+
+class ChecksumMismatchError(Exception):
+    """Raised when the crc32c of a transferred file differs from the one of its blob"""
+    pass
+
+
+class BlobOperationReport:
+    """
+    Outcome of a bulk operation on blobs: names of the blobs processed and BlobFailure of the others.
+    """
+
+    def __init__(self):
+        self.succeeded = []
+        self.failed = []
+
+    def update(self, succeeded, failed):
+        self.succeeded.extend(succeeded)
+        self.failed.extend(failed)
+
+    @property
+    def ok(self):
+        return not self.failed
+
+    def __repr__(self):
+        return '<BlobOperationReport succeeded={} failed={}>'.format(len(self.succeeded), len(self.failed))
+
+
+class SyncReport:
+    """
+    Outcome of sync_prefix: destination names to copy and to delete, number of unchanged blobs, and the
+    BlobOperationReport of the copies and deletions actually run, empty on dry runs.
+    """
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.to_copy = []
+        self.to_delete = []
+        self.unchanged = 0
+        self.copied = BlobOperationReport()
+        self.deleted = BlobOperationReport()
+
+    @property
+    def ok(self):
+        return self.copied.ok and self.deleted.ok
+
+    def __repr__(self):
+        return ('<SyncReport dry_run={} to_copy={} to_delete={} unchanged={} copy_failures={} '
+                'delete_failures={}>').format(
+            self.dry_run, len(self.to_copy), len(self.to_delete), self.unchanged, len(self.copied.failed),
+            len(self.deleted.failed))
+
+
+def _same_content(source_blob, dest_blob):
+    if source_blob.size != dest_blob.size:
+        return False
+    if source_blob.crc32c is not None and dest_blob.crc32c is not None:
+        return source_blob.crc32c == dest_blob.crc32c
+    return source_blob.md5_hash is not None and source_blob.md5_hash == dest_blob.md5_hash
+
+
+def _merge_listings(source_blobs, source_prefix, dest_blobs, dest_prefix):
+    """
+    Joins two listings sorted by name on the name relative to their prefix in a single streaming pass.
+
+    :return: generator of (relative name, source blob or None, destination blob or None)
+    """
+    source_blobs, dest_blobs = iter(source_blobs), iter(dest_blobs)
+    source_blob, dest_blob = next(source_blobs, None), next(dest_blobs, None)
+    while source_blob is not None or dest_blob is not None:
+        source_name = source_blob.name[len(source_prefix):] if source_blob is not None else None
+        dest_name = dest_blob.name[len(dest_prefix):] if dest_blob is not None else None
+        if dest_name is None or (source_name is not None and source_name < dest_name):
+            yield source_name, source_blob, None
+            source_blob = next(source_blobs, None)
+        elif source_name is None or dest_name < source_name:
+            yield dest_name, None, dest_blob
+            dest_blob = next(dest_blobs, None)
+        else:
+            yield source_name, source_blob, dest_blob
+            source_blob, dest_blob = next(source_blobs, None), next(dest_blobs, None)
+
+
+def _put(out, item, stop):
+    """
+    Puts item in a bounded queue unless stop is set while waiting for a free slot.
+
+    :return: False if stop was set
+    """
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _drain(out):
+    """
+    :return: generator of the blobs of a shard queue until its done marker, raising listing errors
+    """
+    while True:
+        page = out.get()
+        if page is _SHARD_DONE:
+            return
+        if isinstance(page, Exception):
+            raise page
+        yield from page
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def _map_bounded(func, items, max_workers):
+    """
+    Applies func to items in a thread pool keeping at most 2 * max_workers calls in flight, so lazy listings
+    are consumed while they are processed instead of being materialized.
+
+    :return: generator of func results in completion order
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for item in items:
+            if len(pending) >= 2 * max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(func, item))
+        for future in as_completed(pending):
+            yield future.result()
+
+
+def _slices(size, slice_size):
+    """
+    :return: list of (start, end) inclusive byte ranges covering size bytes
+    """
+    return [(start, min(start + slice_size, size) - 1) for start in range(0, size, slice_size)]
+
+
+def _file_crc32c(file_path, chunk_size=8 * 1024 * 1024):
+    """
+    :return: base64 encoded crc32c of the file, as in Blob.crc32c
+    """
+    checksum = google_crc32c.Checksum()
+    with open(file_path, 'rb') as local_file:
+        for chunk in iter(lambda: local_file.read(chunk_size), b''):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode('utf-8')
+
+
+class _ParquetFileBuffer:
+    """
+    Parquet file encoded in memory, rolled by the dataset writer once it reaches its rows or bytes limit.
+    """
+
+    def __init__(self, name, schema, partition=None, **kwargs):
+        self.name = name
+        self.partition = partition or {}
+        self.rows = 0
+        self._sink = pa.BufferOutputStream()
+        self._writer = pq.ParquetWriter(self._sink, schema, **kwargs)
+
+    def write(self, table):
+        self._writer.write_table(table)
+        self.rows += table.num_rows
+
+    @property
+    def size(self):
+        return self._sink.tell()
+
+    def close(self):
+        """
+        :return: pyarrow Buffer of the whole Parquet file
+        """
+        self._writer.close()
+        return self._sink.getvalue()
+
+
+def _split_partitions(table, partition_cols):
+    """
+    :param table: pyarrow Table
+    :param partition_cols: list of column names
+    :return: generator of (tuple of partition values, table without partition_cols)
+    """
+    if not partition_cols:
+        yield (), table
+        return
+    keys = table.select(partition_cols).group_by(partition_cols).aggregate([])
+    data = table.drop_columns(partition_cols)
+    for values in zip(*[keys.column(col).to_pylist() for col in partition_cols]):
+        mask = None
+        for col, value in zip(partition_cols, values):
+            col_mask = pc.is_null(table.column(col)) if value is None else pc.equal(table.column(col), value)
+            mask = col_mask if mask is None else pc.and_(mask, col_mask)
+        yield values, data.filter(mask)
+
+
+_FILTER_OPERATORS = {
+    '=': operator.eq, '==': operator.eq, '!=': operator.ne,
+    '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+}
+
+
+def _may_match(op, value, min_value, max_value):
+    """
+    :return: False only when no value in [min_value, max_value] can satisfy op value
+    """
+    if op in ('=', '=='):
+        return min_value <= value <= max_value
+    if op == '!=':
+        return not (min_value == max_value == value)
+    if op == '<':
+        return min_value < value
+    if op == '<=':
+        return min_value <= value
+    if op == '>':
+        return max_value > value
+    if op == '>=':
+        return max_value >= value
+    if op == 'in':
+        return any(min_value <= item <= max_value for item in value)
+    if op == 'not in':
+        return not (min_value == max_value and min_value in value)
+    raise ValueError('Unsupported filter operator {}'.format(op))
+
+
+def _parse_partition_value(value):
+    if value == _HIVE_NULL:
+        return None
+    for parse in (int, float):
+        try:
+            return parse(value)
+        except ValueError:
+            pass
+    return value
+
+
+def _get_partition_values(name, prefix):
+    """
+    :param name: blob name, like prefix/year=2024/month=1/part-00000.parquet
+    :param prefix: dataset prefix
+    :return: dict of hive partition {col: value} found in name after prefix
+    """
+    relative = name[len(prefix):].strip('/')
+    partition = {}
+    for part in relative.split('/')[:-1]:
+        if '=' in part:
+            col, value = part.split('=', 1)
+            partition[unquote(col)] = _parse_partition_value(unquote(value))
+    return partition
+
+
+def _matches_partition(partition, filters):
+    for col, op, value in filters:
+        if col not in partition or partition[col] is None:
+            continue
+        if op in ('in', 'not in'):
+            if (partition[col] in value) != (op == 'in'):
+                return False
+        elif not _FILTER_OPERATORS[op](partition[col], value):
+            return False
+    return True
+
+
+def _prune_row_groups(metadata, filters):
+    """
+    :param metadata: pyarrow FileMetaData
+    :param filters: list of (col, op, value), combined with AND
+    :return: indexes of the row groups whose min/max statistics may match filters
+    """
+    col_indexes = {metadata.schema.column(i).path: i for i in range(metadata.num_columns)}
+    row_groups = []
+    for rg in range(metadata.num_row_groups):
+        row_group = metadata.row_group(rg)
+        keep = True
+        for col, op, value in filters:
+            if col not in col_indexes:
+                continue
+            stats = row_group.column(col_indexes[col]).statistics
+            if stats is None or not stats.has_min_max:
+                continue
+            try:
+                keep = _may_match(op, value, stats.min, stats.max)
+            except TypeError:
+                keep = True
+            if not keep:
+                break
+        if keep:
+            row_groups.append(rg)
+    return row_groups
 
 
 class GStorageConnector:
-    def __init__(self, confs_path=None, auth_type='service_account', json_keyfile_dict=None, logger=None):
+    def __init__(self, confs_path=None, auth_type='service_account', json_keyfile_dict=None, logger=None,
+                 blob_cache=None):
+        """
+        :param confs_path: path of the service account json keyfile
+        :param auth_type: authentication type
+        :param json_keyfile_dict: service account json keyfile as dict
+        :param logger: logger, default does not log
+        :param blob_cache: BlobCache used by get_blob_file and mmap_blob, None to download to a temporary file
+        """
         self.confs_path = confs_path
         self.json_keyfile_dict = json_keyfile_dict
         self.auth_type = auth_type
@@ -34,10 +373,45 @@ class GStorageConnector:
         else:
             self.service = storage.Client()
         self.logger = logger if logger is not None else EmptyLogger()
+        self.blob_cache = blob_cache
+
+    def pd_to_gstorage_stream(self, df, bucket_name, file_name_path, row_group_size=100000,
+                              chunk_size=16 * 1024 * 1024, **kwargs):
+        """
+        Streams a pandas DataFrame as Parquet row groups straight into a resumable GCS upload, without local
+        files. Memory is bounded by one row group plus one upload chunk. The storage client honours
+        STORAGE_EMULATOR_HOST, so it can run against a local fake GCS server.
+
+        :param df: pandas DataFrame, pyarrow Table or an iterator of them, an empty iterator raises ValueError
+        :param bucket_name: The name of the GCS bucket where the file will be saved.
+        :param file_name_path: The path to save the file on the bucket.
+        :param row_group_size: number of rows of each Parquet row group
+        :param chunk_size: bytes sent by each resumable upload request, multiple of 256 KB
+        :param **kwargs: Additional keyword arguments to pass to pyarrow ParquetWriter, like compression.
+        :return: True if the file is saved successfully, or an error if the operation fails.
+        """
+        tables = iter_arrow_tables(df, chunk_rows=row_group_size, hold_null_columns=True)
+        first_table = next(tables, None)
+        if first_table is None:
+            # an empty DataFrame or Table is written as a Parquet file with its schema and no rows
+            if not isinstance(df, (pd.DataFrame, pa.Table, pa.RecordBatch)):
+                raise ValueError('No data to write to gs://{}/{}'.format(bucket_name, file_name_path))
+            first_table = to_arrow_table(df)
+
+        blob = self.service.bucket(bucket_name).blob(file_name_path, chunk_size=chunk_size)
+        with blob.open('wb', content_type='application/octet-stream', ignore_flush=True) as sink:
+            writer = pq.ParquetWriter(sink, first_table.schema, **kwargs)
+            try:
+                for table in chain([first_table], tables):
+                    if table.num_rows:
+                        writer.write_table(table)
+            finally:
+                writer.close()
+        return True
 
     @retry((socket.timeout, requests.exceptions.ConnectionError, urllib3.exceptions.ProtocolError), tries=3, delay=2)
     def pd_to_gstorage(self, df, bucket_name, file_name_path, tempfile_mode=True, partition_cols=None,
-                       engine='pyarrow', **kwargs):
+                       engine='pyarrow', streaming=False, row_group_size=100000, **kwargs):
         """
         Saves a pandas DataFrame to Google Cloud Storage (GCS).
 
@@ -50,9 +424,15 @@ class GStorageConnector:
                               If None, no partitioning will be performed.
         :param engine: The engine to use for saving the DataFrame to parquet format.
                        Defaults to 'pyarrow'.
+        :param streaming: If True, streams row groups into a resumable upload without temporary files,
+                          see pd_to_gstorage_stream. Only without partition_cols and with pyarrow engine.
+        :param row_group_size: number of rows of each Parquet row group in streaming mode.
         :param **kwargs: Additional keyword arguments to pass to the `to_parquet` method.
         :return: True if the file is saved successfully, or an error if the operation fails.
         """
+        if streaming and partition_cols is None and engine == 'pyarrow':
+            return self.pd_to_gstorage_stream(df, bucket_name, file_name_path, row_group_size=row_group_size,
+                                              **kwargs)
         if partition_cols is None:
             if tempfile_mode:
                 bucket = self.service.get_bucket(bucket_name)
@@ -78,20 +458,570 @@ class GStorageConnector:
                 index=False, partition_cols=partition_cols, engine=engine, **kwargs)
             return True
 
-    def recursive_delete(self, bucket_name, directory_path_to_delete):
+    @retry((socket.timeout, requests.exceptions.ConnectionError, urllib3.exceptions.ProtocolError), tries=3, delay=2)
+    def _upload_buffer(self, bucket, name, buffer, content_type='application/octet-stream'):
+        bucket.blob(name).upload_from_file(pa.BufferReader(buffer), size=buffer.size, content_type=content_type,
+                                           rewind=True)
+        return name
+
+    def write_dataset(self, frames, bucket_name, prefix, max_rows_per_file=1000000, max_bytes_per_file=None,
+                      partition_cols=None, row_group_size=100000, max_workers=4, max_open_files=32, **kwargs):
+        """
+        Writes a DataFrame or an iterator of DataFrames / Arrow batches, e.g. BigQueryConnector.iter_dataframes,
+        as a Parquet dataset under prefix. Files are encoded in memory and rolled when they reach
+        max_rows_per_file rows or max_bytes_per_file bytes, finished files are uploaded in parallel while the
+        next ones are encoded. At most max_workers files wait for upload and, with partition_cols, at most
+        max_open_files partitions are encoded at once, the largest one is rolled to open a new one, so memory
+        stays bounded whatever the dataset size. When a null column of the first frames gets a type, open files
+        are rolled and the next ones use the new schema. A _manifest.json listing files, row counts and the last
+        schema is written last.
+
+        :param frames: pandas DataFrame, pyarrow Table, RecordBatch or an iterator of them
+        :param bucket_name: GCS bucket name
+        :param prefix: dataset path on the bucket, without trailing slash
+        :param max_rows_per_file: max number of rows of each file
+        :param max_bytes_per_file: approximate max size of each file, None for no size limit
+        :param partition_cols: list of columns used for hive partitioning, like prefix/col=value/part-00000.parquet
+        :param row_group_size: number of rows of each Parquet row group
+        :param max_workers: number of parallel uploads
+        :param max_open_files: max number of files encoded in memory at once
+        :param **kwargs: Additional keyword arguments to pass to pyarrow ParquetWriter, like compression.
+        :return: manifest dict
+        """
+        bucket = self.service.bucket(bucket_name)
+        prefix = prefix.rstrip('/')
+        partition_cols = list(partition_cols or [])
+        open_files = {}
+        manifest = {'files': [], 'total_rows': 0, 'partition_cols': partition_cols, 'schema': None}
+        file_index = [0]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            uploads = deque()
+
+            def roll(key):
+                parquet_file = open_files.pop(key)
+                buffer = parquet_file.close()
+                while len(uploads) >= max_workers:
+                    uploads.popleft().result()
+                uploads.append(executor.submit(self._upload_buffer, bucket, parquet_file.name, buffer))
+                manifest['files'].append({'name': parquet_file.name, 'rows': parquet_file.rows, 'bytes': buffer.size,
+                                          'partition': parquet_file.partition})
+                manifest['total_rows'] += parquet_file.rows
+                self.logger.info('uploading {} ({} rows, {} bytes)'.format(parquet_file.name, parquet_file.rows,
+                                                                          buffer.size))
+
+            def open_file(key, schema):
+                partition = dict(zip(partition_cols, key))
+                directory = '/'.join([prefix] + [
+                    '{}={}'.format(col, _HIVE_NULL if partition[col] is None else partition[col])
+                    for col in partition_cols])
+                name = '{}/part-{:05d}.parquet'.format(directory, file_index[0])
+                file_index[0] += 1
+                if len(open_files) >= max_open_files:
+                    roll(max(open_files, key=lambda open_key: open_files[open_key].size))
+                open_files[key] = _ParquetFileBuffer(name, schema, partition=partition, **kwargs)
+                return open_files[key]
+
+            schema = None
+            for table in iter_arrow_tables(frames, chunk_rows=row_group_size):
+                if schema is None or not table.schema.equals(schema):
+                    # a Parquet file has a single schema, the files of the former one are finished first
+                    for key in list(open_files):
+                        roll(key)
+                    schema = table.schema
+                    manifest['schema'] = [{'name': field.name, 'type': str(field.type)} for field in schema]
+                for key, part in _split_partitions(table, partition_cols):
+                    offset = 0
+                    while offset < part.num_rows:
+                        parquet_file = open_files.get(key) or open_file(key, part.schema)
+                        chunk = part.slice(offset, max_rows_per_file - parquet_file.rows)
+                        parquet_file.write(chunk)
+                        offset += chunk.num_rows
+                        if parquet_file.rows >= max_rows_per_file or \
+                                (max_bytes_per_file is not None and parquet_file.size >= max_bytes_per_file):
+                            roll(key)
+
+            for key in list(open_files):
+                roll(key)
+            for upload in uploads:
+                upload.result()
+
+        manifest['files'].sort(key=itemgetter('name'))
+        self._upload_buffer(bucket, '{}/_manifest.json'.format(prefix),
+                            pa.py_buffer(json.dumps(manifest, indent=2, default=str).encode('utf-8')),
+                            content_type='application/json')
+        return manifest
+
+    @retry((socket.timeout, requests.exceptions.ConnectionError, urllib3.exceptions.ProtocolError), tries=3, delay=2)
+    def _read_parquet_metadata(self, blob, read_chunk_size):
+        with blob.open('rb', chunk_size=read_chunk_size) as reader:
+            return pq.read_metadata(reader)
+
+    @retry((socket.timeout, requests.exceptions.ConnectionError, urllib3.exceptions.ProtocolError), tries=3, delay=2)
+    def _read_row_group(self, blob, metadata, row_group, columns, read_chunk_size):
+        with blob.open('rb', chunk_size=read_chunk_size) as reader:
+            return pq.ParquetFile(reader, metadata=metadata).read_row_group(row_group, columns=columns)
+
+    def pd_from_gstorage(self, bucket_name, prefix, columns=None, filters=None, as_arrow=False, max_workers=8,
+                         read_chunk_size=1024 * 1024):
+        """
+        Reads a Parquet file or a hive partitioned dataset, like the ones written by write_dataset, with ranged
+        reads. Files whose partition path does not match filters are skipped, then footers are read in parallel,
+        row groups are pruned with their min/max statistics and the remaining column chunks are downloaded
+        concurrently, so only the needed bytes of the files are transferred.
+
+        :param bucket_name: GCS bucket name
+        :param prefix: path of a dataset, or of a single Parquet file when nothing is stored under prefix/
+        :param columns: list of columns to read, None for all of them
+        :param filters: list of (col, op, value) combined with AND, op in =, ==, !=, <, <=, >, >=, in, not in
+        :param as_arrow: if True returns a pyarrow Table instead of a pandas DataFrame
+        :param max_workers: number of parallel reads
+        :param read_chunk_size: bytes fetched by each ranged read
+        :return: pandas DataFrame or pyarrow Table
+        """
+        filters = [tuple(condition) for condition in filters or []]
+        for col, op, value in filters:
+            if op not in _FILTER_OPERATORS and op not in ('in', 'not in'):
+                raise ValueError('Unsupported filter operator {} on {}'.format(op, col))
+
+        # a dataset prefix is listed as a directory, so exports/sales does not match exports/sales_backup/...
+        dataset_prefix = prefix.rstrip('/') + '/'
+        candidates = []
+        for blob in self.service.list_blobs(bucket_name, prefix=dataset_prefix):
+            basename = posixpath.basename(blob.name)
+            if not basename or basename.startswith(('_', '.')) or blob.name.endswith('/'):
+                continue
+            candidates.append((blob, _get_partition_values(blob.name, dataset_prefix)))
+        if not candidates and not prefix.endswith('/'):
+            blob = self.service.bucket(bucket_name).get_blob(prefix)
+            if blob is not None:
+                candidates.append((blob, {}))
+        blobs = [(blob, partition) for blob, partition in candidates if _matches_partition(partition, filters)]
+        self.logger.info('reading {} of {} files from gs://{}/{}'.format(len(blobs), len(candidates), bucket_name,
+                                                                       prefix))
+
+        partition_cols = []
+        for _, partition in candidates:
+            partition_cols.extend(col for col in partition if col not in partition_cols)
+        read_columns = None
+        if columns is not None:
+            read_columns = [col for col in columns if col not in partition_cols]
+            read_columns += [col for col, _, _ in filters if col not in read_columns and col not in partition_cols]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            footers = list(executor.map(lambda item: self._read_parquet_metadata(item[0], read_chunk_size), blobs))
+            tasks = []
+            for (blob, partition), metadata in zip(blobs, footers):
+                for row_group in _prune_row_groups(metadata, filters):
+                    tasks.append((blob, partition, metadata, row_group))
+            self.logger.info('reading {} of {} row groups'.format(
+                len(tasks), sum(metadata.num_row_groups for metadata in footers)))
+            tables = list(executor.map(
+                lambda task: self._read_row_group(task[0], task[2], task[3], read_columns, read_chunk_size), tasks))
+
+        if not tables and candidates:
+            # every file or row group was pruned, the schema comes from any footer of the dataset
+            metadata = footers[0] if footers else self._read_parquet_metadata(candidates[0][0], read_chunk_size)
+            schema = metadata.schema.to_arrow_schema()
+            tables = [schema.empty_table().select(read_columns) if read_columns is not None else schema.empty_table()]
+            tasks = [(None, {}, None, None)]
+        partition_types = {}
+        for col in partition_cols:
+            try:
+                partition_types[col] = pa.array([partition.get(col) for _, partition in candidates]).type
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                partition_types[col] = pa.string()
+                for _, partition in candidates:
+                    if partition.get(col) is not None:
+                        partition[col] = str(partition[col])
+        for i, (table, (_, partition, _, _)) in enumerate(zip(tables, tasks)):
+            for col in partition_cols:
+                tables[i] = tables[i].append_column(
+                    col, pa.array([partition.get(col)] * table.num_rows, type=partition_types[col]))
+
+        if not tables:
+            table = pa.table({})
+        else:
+            # null columns of files written before the column got values take the type of the other files
+            table = pa.concat_tables(tables, promote_options='default')
+            if filters:
+                table = table.filter(pq.filters_to_expression(filters))
+            if columns is not None:
+                table = table.select(columns)
+        if as_arrow:
+            return table
+        return table.to_pandas()
+
+    @retry((socket.timeout, requests.exceptions.ConnectionError, urllib3.exceptions.ProtocolError), tries=3, delay=2)
+    def _download_slice(self, blob, file_path, start, end):
+        with open(file_path, 'r+b') as local_file:
+            local_file.seek(start)
+            blob.download_to_file(local_file, start=start, end=end, checksum=None)
+        return end - start + 1
+
+    def download_blob_sliced(self, bucket_name, blob_name, file_path, slice_size=64 * 1024 * 1024, max_workers=8,
+                             verify=True):
+        """
+        Downloads a large blob with concurrent byte range requests, each one written in place into a
+        preallocated local file. The generation of the blob is pinned, so slices can not mix two versions.
+
+        :param bucket_name: GCS bucket name
+        :param blob_name: blob to download
+        :param file_path: local destination path
+        :param slice_size: bytes of each range request
+        :param max_workers: number of parallel range requests
+        :param verify: whether to compare the crc32c of the local file with the one of the blob
+        :return: local file path
+        """
+        blob = self.service.bucket(bucket_name).get_blob(blob_name)
+        if blob is None:
+            raise google.api_core.exceptions.NotFound('gs://{}/{}'.format(bucket_name, blob_name))
+        with open(file_path, 'wb') as local_file:
+            local_file.truncate(blob.size)
+
+        downloaded = 0
+        for size in _map_bounded(lambda byte_range: self._download_slice(blob, file_path, *byte_range),
+                                 _slices(blob.size, slice_size), max_workers):
+            downloaded += size
+            self.logger.debug('downloaded {}/{} bytes of {}'.format(downloaded, blob.size, blob_name))
+
+        if verify and blob.crc32c is not None and _file_crc32c(file_path) != blob.crc32c:
+            os.remove(file_path)
+            raise ChecksumMismatchError('crc32c of {} does not match gs://{}/{}'.format(file_path, bucket_name,
+                                                                                      blob_name))
+        return file_path
+
+    @retry((socket.timeout, requests.exceptions.ConnectionError, urllib3.exceptions.ProtocolError), tries=3, delay=2)
+    def _upload_slice(self, bucket, name, file_path, start, end):
+        with open(file_path, 'rb') as local_file:
+            local_file.seek(start)
+            bucket.blob(name).upload_from_file(local_file, size=end - start + 1, checksum='crc32c')
+        return name
+
+    @retry((google.api_core.exceptions.GatewayTimeout, google.api_core.exceptions.ServiceUnavailable), tries=3,
+           delay=2)
+    def _compose(self, bucket, name, source_names, content_type=None):
+        blob = bucket.blob(name)
+        blob.content_type = content_type
+        blob.compose([bucket.blob(source_name) for source_name in source_names])
+        return name
+
+    def upload_blob_composite(self, file_path, bucket_name, blob_name, slice_size=64 * 1024 * 1024, max_workers=8,
+                              verify=True, content_type='application/octet-stream'):
+        """
+        Uploads a large local file as a parallel composite upload: slices are uploaded concurrently as
+        temporary component objects, composed 32 at a time into the destination blob and then deleted.
+        Composite objects have a crc32c but no md5 hash.
+
+        :param file_path: local file to upload
+        :param bucket_name: GCS bucket name
+        :param blob_name: destination blob name
+        :param slice_size: bytes of each component object
+        :param max_workers: number of parallel uploads and compose requests
+        :param verify: whether to compare the crc32c of the final blob with the one of the local file
+        :param content_type: content type of the destination blob
+        :return: destination blob
+        """
+        bucket = self.service.bucket(bucket_name)
+        size = os.path.getsize(file_path)
+        if size <= slice_size:
+            blob = bucket.blob(blob_name)
+            blob.upload_from_filename(file_path, content_type=content_type, checksum='crc32c')
+            return blob
+
+        temp_prefix = '{}.parts-{}'.format(blob_name, uuid.uuid4().hex[:8])
+        temp_names = []
+        try:
+            for name in _map_bounded(
+                    lambda item: self._upload_slice(bucket, '{}/{:05d}'.format(temp_prefix, item[0]), file_path,
+                                                    *item[1]),
+                    enumerate(_slices(size, slice_size)), max_workers):
+                temp_names.append(name)
+                self.logger.debug('uploaded component {} of {}'.format(name, blob_name))
+            components = sorted(temp_names)
+
+            level = 0
+            while len(components) > _MAX_COMPOSE_SOURCES:
+                groups = list(_chunks(components, _MAX_COMPOSE_SOURCES))
+                intermediates = ['{}/compose-{}-{:05d}'.format(temp_prefix, level, i) for i in range(len(groups))]
+                temp_names.extend(intermediates)
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    list(executor.map(lambda args: self._compose(bucket, *args), zip(intermediates, groups)))
+                components = intermediates
+                level += 1
+            self._compose(bucket, blob_name, components, content_type=content_type)
+        finally:
+            if temp_names:
+                report = self.delete_blobs([bucket.blob(name) for name in temp_names], max_workers=max_workers)
+                for failure in report.failed:
+                    self.logger.warning('could not delete component {}: {}'.format(failure.name, failure.error))
+
+        blob = bucket.get_blob(blob_name)
+        if verify and blob.crc32c != _file_crc32c(file_path):
+            raise ChecksumMismatchError('crc32c of gs://{}/{} does not match {}'.format(bucket_name, blob_name,
+                                                                                      file_path))
+        return blob
+
+    def get_blob_file(self, bucket_name, blob_name, validate=True):
+        """
+        Returns a local copy of a blob, read through the connector blob_cache. With validate the blob metadata is
+        fetched to check the cached generation and md5, otherwise any cached copy is used without requests.
+        Without blob_cache the blob is downloaded to a temporary file that the caller has to remove. A cached path can
+        be evicted by another process once returned, mmap_blob maps the file safely.
+
+        :param bucket_name: GCS bucket name
+        :param blob_name: blob name
+        :param validate: whether to check the cached copy against the blob metadata
+        :return: local file path
+        """
+        if self.blob_cache is not None and not validate:
+            path = self.blob_cache.lookup(bucket_name, blob_name)
+            if path is not None:
+                return path
+
+        blob = self.service.bucket(bucket_name).get_blob(blob_name)
+        if blob is None:
+            raise google.api_core.exceptions.NotFound('gs://{}/{}'.format(bucket_name, blob_name))
+        if self.blob_cache is not None:
+            return self.blob_cache.get(blob)
+
+        fd, path = tempfile.mkstemp(suffix=posixpath.basename(blob_name))
+        os.close(fd)
+        blob.download_to_filename(path)
+        return path
+
+    def mmap_blob(self, bucket_name, blob_name, validate=True):
+        """
+        The blob file is opened under the blob_cache lock, so the mapping stays valid even if the cache entry is
+        evicted afterwards. Without blob_cache the temporary download is removed once mapped.
+
+        :param bucket_name: GCS bucket name
+        :param blob_name: blob name
+        :param validate: whether to check the cached copy against the blob metadata, see get_blob_file
+        :return: read-only mmap of the local copy of the blob, b'' for empty blobs
+        """
+        local_file = None
+        if self.blob_cache is not None and not validate:
+            local_file = self.blob_cache.open_cached(bucket_name, blob_name)
+        if local_file is None:
+            blob = self.service.bucket(bucket_name).get_blob(blob_name)
+            if blob is None:
+                raise google.api_core.exceptions.NotFound('gs://{}/{}'.format(bucket_name, blob_name))
+            if self.blob_cache is not None:
+                local_file = self.blob_cache.open(blob)
+            else:
+                fd, path = tempfile.mkstemp(suffix=posixpath.basename(blob_name))
+                os.close(fd)
+                try:
+                    blob.download_to_filename(path)
+                    local_file = open(path, 'rb')
+                finally:
+                    os.remove(path)
+
+        with local_file:
+            if os.fstat(local_file.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(local_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _iter_listing_items(self, bucket_name, prefix, delimiter, depth):
+        """
+        Streams a delimiter listing page by page, each page holds at most one page of blobs and prefixes.
+
+        :return: generator of (sort key, blob or None, shard prefix or None) in name order, blobs directly under
+                 prefix and sub-prefixes expanded up to depth levels
+        """
+        iterator = self.service.list_blobs(bucket_name, prefix=prefix, delimiter=delimiter)
+        for page in iterator.pages:
+            items = [(blob.name, blob, None) for blob in page]
+            items.extend((sub_prefix, None, sub_prefix) for sub_prefix in page.prefixes)
+            items.sort(key=itemgetter(0))
+            for name, blob, shard in items:
+                if shard is not None and depth > 1:
+                    yield from self._iter_listing_items(bucket_name, shard, delimiter, depth - 1)
+                else:
+                    yield name, blob, shard
+
+    def _list_shard(self, bucket_name, prefix, out, stop):
+        if stop.is_set():
+            # the consumer is gone, shards still waiting for a thread are not listed
+            return
+        try:
+            for page in self.service.list_blobs(bucket_name, prefix=prefix).pages:
+                if not _put(out, list(page), stop):
+                    return
+            _put(out, _SHARD_DONE, stop)
+        except Exception as e:
+            _put(out, e, stop)
+
+    def list_blobs_sharded(self, bucket_name, prefix=None, ordered=True, reverse=False, max_workers=8, depth=1,
+                           delimiter='/', prefetch_pages=4):
+        """
+        Lists every blob under prefix faster than a single paginated listing: sub-prefixes are discovered with a
+        delimiter listing, then each of them is listed concurrently as a separate shard. Blobs are yielded as
+        soon as their pages arrive, so consumers can start working while the listing goes on, and the delimiter
+        listing itself is streamed, so a flat prefix is not held in memory.
+
+        Shards cover disjoint name ranges, so ordered output only needs to yield them one after the other while
+        the next max_workers ones are prefetched. In reverse order the delimiter listing and one shard at a time
+        are held in memory instead of the whole listing.
+
+        :param bucket_name: GCS bucket name
+        :param prefix: path of the blobs to list
+        :param ordered: if True yields blobs sorted by name, otherwise in arrival order
+        :param reverse: if True yields blobs in descending name order, only with ordered
+        :param max_workers: number of shards listed in parallel
+        :param depth: number of delimiter levels expanded into shards
+        :param delimiter: delimiter used to discover the sub-prefixes
+        :param prefetch_pages: number of pages of each shard listed ahead of the consumer
+        :return: generator of blobs
+        """
+        items = self._iter_listing_items(bucket_name, prefix, delimiter, depth)
+        if reverse:
+            items = iter(list(items)[::-1])
+        stop = threading.Event()
+        # one more thread than max_workers for the discovery of unordered listings
+        with ThreadPoolExecutor(max_workers=max_workers + 1) as executor:
+            try:
+                if ordered:
+                    yield from self._iter_ordered_shards(bucket_name, items, executor, stop, max_workers,
+                                                         prefetch_pages, reverse)
+                else:
+                    yield from self._iter_unordered_shards(bucket_name, items, executor, stop, max_workers,
+                                                           prefetch_pages)
+            finally:
+                stop.set()
+
+    def _iter_ordered_shards(self, bucket_name, items, executor, stop, max_workers, prefetch_pages, reverse):
+        queues = {}
+        lookahead = deque()
+        started = [0]
+
+        def prefetch():
+            # reads the listing ahead until max_workers shards are running, or a page of direct blobs is buffered
+            while started[0] < max_workers and len(lookahead) < 1000:
+                item = next(items, None)
+                if item is None:
+                    return
+                shard = item[2]
+                if shard is not None:
+                    queues[shard] = queue.Queue(maxsize=prefetch_pages)
+                    executor.submit(self._list_shard, bucket_name, shard, queues[shard], stop)
+                    started[0] += 1
+                lookahead.append(item)
+
+        prefetch()
+        while lookahead:
+            _, blob, shard = lookahead.popleft()
+            if shard is None:
+                yield blob
+            else:
+                started[0] -= 1
+                prefetch()
+                if reverse:
+                    yield from reversed(list(_drain(queues.pop(shard))))
+                else:
+                    yield from _drain(queues.pop(shard))
+            prefetch()
+
+    def _iter_unordered_shards(self, bucket_name, items, executor, stop, max_workers, prefetch_pages):
+        out = queue.Queue(maxsize=prefetch_pages * max_workers)
+        shards = [0]
+
+        def discover():
+            try:
+                for page in _chunks(items, 1000):
+                    blobs = []
+                    for _, blob, shard in page:
+                        if stop.is_set():
+                            return
+                        if shard is None:
+                            blobs.append(blob)
+                        else:
+                            shards[0] += 1
+                            executor.submit(self._list_shard, bucket_name, shard, out, stop)
+                    if blobs and not _put(out, blobs, stop):
+                        return
+                _put(out, _DISCOVERY_DONE, stop)
+            except Exception as e:
+                _put(out, e, stop)
+
+        executor.submit(discover)
+        discovered = False
+        done = 0
+        while not discovered or done < shards[0]:
+            page = out.get()
+            if page is _DISCOVERY_DONE:
+                discovered = True
+            elif page is _SHARD_DONE:
+                done += 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                yield from page
+
+    def _delete_batch(self, blobs):
+        """
+        Deletes blobs with a single batch request. When the batch fails blobs are deleted one by one to know
+        which ones failed, the ones already deleted by the batch are not found and counted as deleted.
+
+        :param blobs: list of blobs, at most 1000
+        :return: tuple of (deleted blob names, list of BlobFailure)
+        """
+        try:
+            with self.service.batch():
+                for blob in blobs:
+                    blob.delete()
+            return [blob.name for blob in blobs], []
+        except Exception as e:
+            self.logger.warning('batch delete failed, deleting one by one: {}'.format(e))
+
+        deleted, failed = [], []
+        for blob in blobs:
+            try:
+                blob.delete()
+                deleted.append(blob.name)
+            except google.api_core.exceptions.NotFound:
+                deleted.append(blob.name)
+            except Exception as e:
+                failed.append(BlobFailure(blob.name, e))
+        return deleted, failed
+
+    def delete_blobs(self, blobs, max_workers=8, batch_size=100):
+        """
+        :param blobs: iterable of blobs to delete
+        :param max_workers: number of batch requests sent in parallel
+        :param batch_size: number of deletions in each batch request, at most 1000
+        :return: BlobOperationReport
+        """
+        report = BlobOperationReport()
+        for deleted, failed in _map_bounded(self._delete_batch, _chunks(blobs, batch_size), max_workers):
+            report.update(deleted, failed)
+            for failure in failed:
+                self.logger.warning('could not delete {}: {}'.format(failure.name, failure.error))
+            self.logger.info('deleted {} blobs, {} failures'.format(len(report.succeeded), len(report.failed)))
+        return report
+
+    def recursive_delete(self, bucket_name, directory_path_to_delete, max_workers=8, batch_size=100,
+                         return_report=False, raise_on_error=True):
         """
         :param bucket_name: GCS bucket name
         :param directory_path_to_delete: path to start recursive deletion
+        :param max_workers: number of batch requests sent in parallel
+        :param batch_size: number of deletions in each batch request, at most 1000
+        :param return_report: if True returns a BlobOperationReport including failures
+        :param raise_on_error: if True raises BlobOperationError once every deletion was tried and some failed
         :return: list of deleted files from GSC
         """
         bucket = self.service.get_bucket(bucket_name)
-        blobs = self.service.list_blobs(bucket.name, prefix=directory_path_to_delete)
-        deleted_files = []
-        for blob in blobs:
-            blob.delete()
-            self.logger.info('deleted {}'.format(blob.name))
-            deleted_files.append(blob.name)
-        return deleted_files
+        blobs = self.list_blobs_sharded(bucket.name, prefix=directory_path_to_delete, ordered=False,
+                                        max_workers=max_workers)
+        report = self.delete_blobs(blobs, max_workers=max_workers, batch_size=batch_size)
+        if raise_on_error and not report.ok:
+            raise BlobOperationError('{} blobs of gs://{}/{} were not deleted'.format(
+                len(report.failed), bucket_name, directory_path_to_delete), report)
+        if return_report:
+            return report
+        return report.succeeded
 
     @retry((google.api_core.exceptions.GatewayTimeout), tries=3, delay=2)
     def copy_blob(self, source_bucket, dest_bucket, blob):
@@ -110,21 +1040,76 @@ class GStorageConnector:
         new_blob = bucket.rename_blob(blob, new_name)
         return new_blob
 
+    @retry((google.api_core.exceptions.GatewayTimeout, google.api_core.exceptions.ServiceUnavailable), tries=3,
+           delay=2)
+    def _rewrite_step(self, dest_blob, source_blob, token):
+        return dest_blob.rewrite(source_blob, token=token)
+
+    def rewrite_blob(self, source_blob, dest_bucket, new_name=None):
+        """
+        Copies a blob server side with the rewrite API, resuming from the last rewrite token on large objects
+        that need several calls, also after a retried timeout.
+
+        :param source_blob: blob to copy
+        :param dest_bucket: destination bucket
+        :param new_name: name of the copy, default the source blob name
+        :return: destination blob
+        """
+        dest_blob = dest_bucket.blob(new_name or source_blob.name)
+        token, bytes_rewritten, total_bytes = self._rewrite_step(dest_blob, source_blob, None)
+        while token is not None:
+            self.logger.debug('rewritten {}/{} bytes of {}'.format(bytes_rewritten, total_bytes, source_blob.name))
+            token, bytes_rewritten, total_bytes = self._rewrite_step(dest_blob, source_blob, token)
+        return dest_blob
+
+    def _copy_task(self, dest_bucket, blob, new_name=None):
+        try:
+            self.rewrite_blob(blob, dest_bucket, new_name=new_name)
+            return [new_name or blob.name], []
+        except Exception as e:
+            return [], [BlobFailure(new_name or blob.name, e)]
+
+    def copy_blobs(self, source_bucket, dest_bucket, blobs, max_workers=8):
+        """
+        :param source_bucket: source bucket
+        :param dest_bucket: destination bucket
+        :param blobs: iterable of blobs of source_bucket to copy with the same name
+        :param max_workers: number of copies running in parallel
+        :return: BlobOperationReport
+        """
+        report = BlobOperationReport()
+        for copied, failed in _map_bounded(lambda blob: self._copy_task(dest_bucket, blob), blobs,
+                                           max_workers):
+            report.update(copied, failed)
+            for name in copied:
+                self.logger.info('copied {} from {} to {}'.format(name, source_bucket.name, dest_bucket.name))
+            for failure in failed:
+                self.logger.warning('could not copy {} from {} to {}: {}'.format(
+                    failure.name, source_bucket.name, dest_bucket.name, failure.error))
+        return report
+
     def recursive_copy_between_buckets(self, source_bucket, dest_bucket, prefix, delimiter='/', to_delete=False,
-                                       reverse_order=False):
+                                       reverse_order=False, max_workers=8, batch_size=100, raise_on_error=True):
         """
         :param source_bucket: source bucket where files are currently located
         :param dest_bucket: destination bucket where to copy files
         :param prefix: to filter based on path hierarchy
-        :param delimiter: wildcard to match files
+        :param delimiter: wildcard to match files, None to copy every blob under prefix listed with
+                          list_blobs_sharded
         :param to_delete: True if you want to delete blobs from source bucket, default is False
         :param reverse_order: True if you want to revert order starting from last added objects
-        :return:
+        :param max_workers: number of copies and batch deletions running in parallel
+        :param batch_size: number of deletions in each batch request, at most 1000
+        :param raise_on_error: if True raises BlobOperationError once every blob was tried and some failed
+        :return: BlobOperationReport of the copies, failed deletions are added to its failures
         """
         source_bucket = self.service.get_bucket(source_bucket)
         dest_bucket = self.service.get_bucket(dest_bucket)
 
-        if reverse_order:
+        if delimiter is None:
+            blobs = self.list_blobs_sharded(source_bucket.name, prefix=prefix, ordered=reverse_order,
+                                            reverse=reverse_order, max_workers=max_workers)
+        elif reverse_order:
             unordered_blobs = self.service.list_blobs(source_bucket.name, prefix=prefix, delimiter=delimiter)
             blobs = []
             for blob in unordered_blobs:
@@ -134,8 +1119,63 @@ class GStorageConnector:
         else:
             blobs = self.service.list_blobs(source_bucket.name, prefix=prefix, delimiter=delimiter)
 
-        for blob in blobs:
-            self.copy_blob(source_bucket=source_bucket, dest_bucket=dest_bucket, blob=blob)
-            self.logger.info('copied {} from {} to {}'.format(blob.name, source_bucket.name, dest_bucket.name))
-            if to_delete is True:
-                source_bucket.delete_blob(blob.name)
+        report = self.copy_blobs(source_bucket, dest_bucket, blobs, max_workers=max_workers)
+        if to_delete is True and report.succeeded:
+            delete_report = self.delete_blobs([source_bucket.blob(name) for name in report.succeeded],
+                                              max_workers=max_workers, batch_size=batch_size)
+            report.failed.extend(delete_report.failed)
+        if raise_on_error and not report.ok:
+            raise BlobOperationError('{} blobs of gs://{}/{} were not copied or deleted'.format(
+                len(report.failed), source_bucket.name, prefix), report)
+        return report
+
+    def sync_prefix(self, source_bucket, dest_bucket, prefix, dest_prefix=None, delete_extraneous=False,
+                    dry_run=False, max_workers=8, batch_size=100):
+        """
+        Mirrors the blobs under prefix of source_bucket to dest_prefix of dest_bucket, like rsync. Both listings are
+        joined by name in one streaming pass, and only new blobs or blobs whose size or crc32c (md5 as fallback)
+        changed are copied with parallel server side rewrites, so a run costs time proportional to the change set.
+
+        :param source_bucket: source bucket name
+        :param dest_bucket: destination bucket name
+        :param prefix: path of the blobs to sync
+        :param dest_prefix: destination path, default prefix
+        :param delete_extraneous: whether to delete destination blobs missing from the source
+        :param dry_run: if True only fills to_copy and to_delete of the report
+        :param max_workers: number of copies and batch deletions running in parallel
+        :param batch_size: number of deletions in each batch request, at most 1000
+        :return: SyncReport
+        """
+        dest_prefix = prefix if dest_prefix is None else dest_prefix
+        source_bucket = self.service.bucket(source_bucket)
+        dest_bucket = self.service.bucket(dest_bucket)
+        report = SyncReport(dry_run=dry_run)
+
+        def copies():
+            for name, source_blob, dest_blob in _merge_listings(
+                    self.list_blobs_sharded(source_bucket.name, prefix=prefix, max_workers=max_workers), prefix,
+                    self.list_blobs_sharded(dest_bucket.name, prefix=dest_prefix, max_workers=max_workers),
+                    dest_prefix):
+                if source_blob is None:
+                    if delete_extraneous:
+                        report.to_delete.append(dest_blob.name)
+                elif dest_blob is not None and _same_content(source_blob, dest_blob):
+                    report.unchanged += 1
+                else:
+                    report.to_copy.append(dest_prefix + name)
+                    yield source_blob, dest_prefix + name
+
+        if dry_run:
+            for _ in copies():
+                pass
+            return report
+
+        for copied, failed in _map_bounded(lambda item: self._copy_task(dest_bucket, *item), copies(), max_workers):
+            report.copied.update(copied, failed)
+            for name in copied:
+                self.logger.info('synced {} to {}'.format(name, dest_bucket.name))
+        if report.to_delete:
+            report.deleted = self.delete_blobs([dest_bucket.blob(name) for name in report.to_delete],
+                                               max_workers=max_workers, batch_size=batch_size)
+        self.logger.info('sync of {} done: {}'.format(prefix, report))
+        return report
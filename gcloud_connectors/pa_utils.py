@@ -0,0 +1,113 @@
+import pandas as pd
+import pyarrow as pa
+
+
+def to_arrow_table(frame, schema=None):
+    """
+    :param frame: pandas DataFrame, pyarrow Table or RecordBatch
+    :param schema: pyarrow Schema to cast to, None to keep the frame one
+    :return: pyarrow Table
+    """
+    if isinstance(frame, pd.DataFrame):
+        return pa.Table.from_pandas(frame, schema=schema, preserve_index=False)
+    if isinstance(frame, pa.RecordBatch):
+        frame = pa.Table.from_batches([frame])
+    if schema is not None and not frame.schema.equals(schema):
+        frame = frame.cast(schema)
+    return frame
+
+
+def _promote_null_fields(schema, other):
+    """
+    :param schema: pyarrow Schema
+    :param other: pyarrow Schema of a later frame
+    :return: schema with its null typed fields replaced by the type of the same field in other
+    """
+    fields = []
+    promoted = False
+    for field in schema:
+        index = other.get_field_index(field.name)
+        if pa.types.is_null(field.type) and index >= 0 and not pa.types.is_null(other.field(index).type):
+            field = field.with_type(other.field(index).type)
+            promoted = True
+        fields.append(field)
+    if not promoted:
+        return schema
+    return pa.schema(fields, metadata=other.metadata)
+
+
+def _hold_null_columns(tables):
+    """
+    :param tables: generator of pyarrow Tables whose null columns may get a type in later tables
+    :return: generator of the same tables, the ones with null columns held back and cast once a later table types
+             them or the input ends
+    """
+    held = []
+    for table in tables:
+        if held and not held[0].schema.equals(table.schema):
+            held = [held_table.cast(table.schema) for held_table in held]
+        if any(pa.types.is_null(field.type) for field in table.schema):
+            held.append(table)
+            continue
+        yield from held
+        held = []
+        yield table
+    yield from held
+
+
+def iter_arrow_tables(frames, chunk_rows=None, hold_null_columns=False):
+    """
+    :param frames: pandas DataFrame, pyarrow Table, RecordBatch or an iterator of them
+    :param chunk_rows: number of rows of each yielded Table, smaller frames are merged and bigger ones sliced,
+                       None to keep the frames as they are
+    :param hold_null_columns: whether to hold back tables with null columns until a later frame types them, so
+                              every table has the same schema, as a single Parquet file needs. Memory then grows
+                              with the rows preceding the first value of such a column
+    :return: generator of pyarrow Tables sharing the schema of the first frame, except that its null columns, like
+             the all None ones of a first BigQuery page, take the type of the first later frame holding values
+    """
+    tables = _iter_arrow_tables(frames, chunk_rows)
+    return _hold_null_columns(tables) if hold_null_columns else tables
+
+
+def _iter_arrow_tables(frames, chunk_rows):
+    if isinstance(frames, (pd.DataFrame, pa.Table, pa.RecordBatch)):
+        frames = [frames]
+    schema = None
+    pending = []
+    pending_rows = 0
+    for frame in frames:
+        if schema is None or any(pa.types.is_null(field.type) for field in schema):
+            if isinstance(frame, pd.DataFrame):
+                frame_schema = pa.Schema.from_pandas(frame, preserve_index=False)
+            else:
+                frame_schema = frame.schema
+            promoted = frame_schema if schema is None else _promote_null_fields(schema, frame_schema)
+            if schema is not None and promoted is not schema:
+                pending = [chunk.cast(promoted) for chunk in pending]
+            schema = promoted
+
+        if isinstance(frame, pd.DataFrame):
+            # DataFrames are converted slice by slice to avoid a full Arrow copy of the frame
+            step = chunk_rows or max(len(frame), 1)
+            tables = (to_arrow_table(frame.iloc[offset:offset + step], schema=schema)
+                      for offset in range(0, max(len(frame), 1), step))
+        else:
+            tables = [to_arrow_table(frame, schema=schema)]
+
+        for table in tables:
+            if chunk_rows is None:
+                yield table
+                continue
+            offset = 0
+            while offset < table.num_rows:
+                chunk = table.slice(offset, chunk_rows - pending_rows)
+                offset += chunk.num_rows
+                pending.append(chunk)
+                pending_rows += chunk.num_rows
+                if pending_rows == chunk_rows:
+                    yield pa.concat_tables(pending)
+                    pending = []
+                    pending_rows = 0
+    if pending:
+        yield pa.concat_tables(pending)
@@ -0,0 +1,63 @@
+"""
+Runs BigQueryConnector.pd_to_bigquery against a fake BigQuery client capturing the loaded Parquet file.
+"""
+import io
+
+import google.auth
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+from google.auth.credentials import AnonymousCredentials
+
+from gcloud_connectors.bigquery import BigQueryConnector
+
+
+class FakeLoadJob:
+    def __init__(self, output_rows):
+        self.output_rows = output_rows
+
+    def result(self):
+        return self
+
+
+class FakeClient:
+    def __init__(self):
+        self.loaded = []
+
+    def load_table_from_file(self, source, table, job_config=None):
+        parquet_table = pq.read_table(io.BytesIO(source.read()))
+        self.loaded.append((table, parquet_table))
+        return FakeLoadJob(parquet_table.num_rows)
+
+
+@pytest.fixture
+def connector(monkeypatch):
+    monkeypatch.setattr(google.auth, 'default', lambda scopes=None: (AnonymousCredentials(), 'test'))
+    connector = BigQueryConnector('test')
+    connector.service = FakeClient()
+    return connector
+
+
+def test_iterator(connector):
+    frames = [pd.DataFrame({'a': range(5)}), pd.DataFrame({'a': range(5, 8)})]
+    load_job = connector.pd_to_bigquery(iter(frames), 'dataset.table', row_group_size=2)
+
+    assert load_job.output_rows == 8
+    table, parquet_table = connector.service.loaded[0]
+    assert table == 'dataset.table'
+    assert parquet_table.column('a').to_pylist() == list(range(8))
+
+
+def test_iterator_null_first_row_group(connector):
+    frames = [pd.DataFrame({'a': [1, 2], 's': [None, None]}), pd.DataFrame({'a': [3], 's': ['x']})]
+    connector.pd_to_bigquery(iter(frames), 'dataset.table', row_group_size=2)
+
+    _, parquet_table = connector.service.loaded[0]
+    assert str(parquet_table.schema.field('s').type) == 'string'
+    assert parquet_table.column('s').to_pylist() == [None, None, 'x']
+
+
+def test_empty_iterator_raises(connector):
+    with pytest.raises(ValueError):
+        connector.pd_to_bigquery(iter([]), 'dataset.table')
+    assert connector.service.loaded == []
@@ -0,0 +1,83 @@
+"""
+Runs the BigQuery Storage read of BigQueryConnector against a fake read client and read session.
+"""
+import threading
+
+import google.auth
+import pyarrow as pa
+import pytest
+from google.auth.credentials import AnonymousCredentials
+from google.cloud.bigquery_storage_v1 import types as bqstorage_types
+
+from gcloud_connectors.bigquery import BigQueryConnector
+
+SCHEMA = pa.schema([('stream', pa.string()), ('value', pa.int64())])
+
+
+class FakeReadClient:
+    def __init__(self, batches_per_stream, fail_stream=None):
+        self.batches_per_stream = batches_per_stream
+        self.fail_stream = fail_stream
+        self.opened = []
+        self.lock = threading.Lock()
+
+    def read_rows(self, stream_name):
+        with self.lock:
+            self.opened.append(stream_name)
+        if stream_name == self.fail_stream:
+            raise RuntimeError('{} failed'.format(stream_name))
+        for index in range(self.batches_per_stream):
+            batch = pa.record_batch([pa.array([stream_name] * 2), pa.array([2 * index, 2 * index + 1])],
+                                    schema=SCHEMA)
+            yield bqstorage_types.ReadRowsResponse(
+                arrow_record_batch=bqstorage_types.ArrowRecordBatch(
+                    serialized_record_batch=batch.serialize().to_pybytes()))
+
+
+def make_session(stream_count):
+    return bqstorage_types.ReadSession(
+        arrow_schema=bqstorage_types.ArrowSchema(serialized_schema=SCHEMA.serialize().to_pybytes()),
+        streams=[bqstorage_types.ReadStream(name='stream-{}'.format(i)) for i in range(stream_count)])
+
+
+@pytest.fixture
+def connector(monkeypatch):
+    monkeypatch.setattr(google.auth, 'default', lambda scopes=None: (AnonymousCredentials(), 'test'))
+    return BigQueryConnector('test')
+
+
+def test_reads_every_stream(connector):
+    connector.bqstorage_service = FakeReadClient(batches_per_stream=3)
+    connector._create_read_session = lambda table, max_streams: make_session(4)
+
+    table = connector._pa_read_streams(None, max_streams=4, max_workers=2)
+
+    assert table.schema.equals(SCHEMA)
+    assert table.num_rows == 4 * 3 * 2
+    rows = sorted(zip(table.column('stream').to_pylist(), table.column('value').to_pylist()))
+    assert rows == [('stream-{}'.format(i), value) for i in range(4) for value in range(6)]
+
+
+def test_empty_session(connector):
+    connector.bqstorage_service = FakeReadClient(batches_per_stream=3)
+
+    assert list(connector._iter_session_batches(make_session(0))) == []
+    assert connector.bqstorage_service.opened == []
+
+
+def test_stream_error_is_raised(connector):
+    connector.bqstorage_service = FakeReadClient(batches_per_stream=3, fail_stream='stream-1')
+
+    with pytest.raises(RuntimeError, match='stream-1 failed'):
+        list(connector._iter_session_batches(make_session(3)))
+
+
+def test_close_does_not_open_pending_streams(connector):
+    read_client = FakeReadClient(batches_per_stream=1000)
+    connector.bqstorage_service = read_client
+
+    batches = connector._iter_session_batches(make_session(3), max_workers=1, max_queue_size=1)
+    next(batches)
+    batches.close()
+
+    assert read_client.opened == ['stream-0']
@@ -0,0 +1,84 @@
+"""
+Runs GAnalytics4Connector.pd_get_report with shard_by against a fake Data API client.
+"""
+import datetime
+import threading
+import time
+
+import google.auth
+import pytest
+from google.analytics.data_v1beta.types import DimensionHeader
+from google.analytics.data_v1beta.types import DimensionValue
+from google.analytics.data_v1beta.types import MetricHeader
+from google.analytics.data_v1beta.types import MetricType
+from google.analytics.data_v1beta.types import MetricValue
+from google.analytics.data_v1beta.types import Row
+from google.analytics.data_v1beta.types import RunReportResponse
+from google.auth.credentials import AnonymousCredentials
+
+from gcloud_connectors.ga4 import GAnalytics4Connector
+
+ROWS_PER_DAY = 25
+
+
+class FakeDataClient:
+    def __init__(self):
+        self.limits = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def run_report(self, request):
+        with self.lock:
+            self.limits.append(request.limit)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.005)
+        start = datetime.date.fromisoformat(request.date_ranges[0].start_date)
+        end = datetime.date.fromisoformat(request.date_ranges[0].end_date)
+        rows = [(start + datetime.timedelta(days=day), index) for day in range((end - start).days + 1)
+                for index in range(ROWS_PER_DAY)]
+        page = rows[request.offset:request.offset + request.limit]
+        with self.lock:
+            self.active -= 1
+        return RunReportResponse(
+            dimension_headers=[DimensionHeader(name='date')],
+            metric_headers=[MetricHeader(name='sessions', type_=MetricType.TYPE_INTEGER)],
+            rows=[Row(dimension_values=[DimensionValue(value=date.strftime('%Y%m%d'))],
+                      metric_values=[MetricValue(value=str(index))]) for date, index in page],
+            row_count=len(rows))
+
+
+@pytest.fixture
+def connector(monkeypatch):
+    monkeypatch.setattr(google.auth, 'default', lambda scopes=None: (AnonymousCredentials(), 'test'))
+    connector = GAnalytics4Connector(quota_scheduler=False)
+    connector.service = FakeDataClient()
+    return connector
+
+
+@pytest.mark.parametrize('shard_by', ['day', 'week', 'auto'])
+def test_shards_are_merged_in_date_order(connector, shard_by):
+    df = connector.pd_get_report(1, '2024-01-01', '2024-01-10', ['sessions'], ['date'], limit=10,
+                                 shard_by=shard_by, shard_row_threshold=60, categorical_dimensions=False)
+
+    assert len(df) == 10 * ROWS_PER_DAY
+    assert df['date'].tolist() == sorted(df['date'])
+    assert df['sessions'].tolist() == list(range(ROWS_PER_DAY)) * 10
+
+
+def test_auto_probes_ranges_before_paging(connector):
+    connector.pd_get_report(1, '2024-01-01', '2024-01-08', ['sessions'], ['date'], limit=10, shard_by='auto',
+                            shard_row_threshold=60, max_workers=3)
+
+    # 8 days are split into 4 ranges of 2 days with 7 one row probes, only the 5 pages of each range are downloaded
+    limits = connector.service.limits
+    assert limits.count(1) == 7
+    assert limits.count(10) == 4 * 5
+
+
+def test_shard_pages_share_max_workers(connector):
+    connector.pd_get_report(1, '2024-01-01', '2024-01-08', ['sessions'], ['date'], limit=5, shard_by='day',
+                            max_workers=3)
+
+    assert connector.service.max_active <= 3
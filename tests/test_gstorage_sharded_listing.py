@@ -0,0 +1,119 @@
+"""
+Runs GStorageConnector.list_blobs_sharded against a fake storage client.
+"""
+import threading
+import time
+
+import pytest
+
+from gcloud_connectors import gstorage
+from gcloud_connectors.gstorage import GStorageConnector
+
+PAGE_SIZE = 100
+
+
+class FakeBlob:
+    def __init__(self, name):
+        self.name = name
+
+
+class FakePage(list):
+    def __init__(self, blobs, prefixes):
+        super().__init__(blobs)
+        self.prefixes = prefixes
+
+
+class FakeIterator:
+    def __init__(self, client, names, prefix, delimiter):
+        self.client = client
+        self.names = names
+        self.prefix = prefix
+        self.delimiter = delimiter
+
+    @property
+    def pages(self):
+        blobs, prefixes = [], []
+        for name in self.names:
+            if not name.startswith(self.prefix):
+                continue
+            rest = name[len(self.prefix):]
+            if self.delimiter and self.delimiter in rest:
+                sub_prefix = self.prefix + rest[:rest.index(self.delimiter) + 1]
+                if not prefixes or prefixes[-1] != sub_prefix:
+                    prefixes.append(sub_prefix)
+            else:
+                blobs.append(FakeBlob(name))
+        items = [(blob.name, blob, None) for blob in blobs]
+        items.extend((sub_prefix, None, sub_prefix) for sub_prefix in prefixes)
+        items.sort(key=lambda item: item[0])
+        for offset in range(0, max(len(items), 1), PAGE_SIZE):
+            self.client.count_call()
+            page = items[offset:offset + PAGE_SIZE]
+            yield FakePage([blob for _, blob, _ in page if blob is not None],
+                           [sub_prefix for _, _, sub_prefix in page if sub_prefix is not None])
+
+
+class FakeClient:
+    names = []
+    delay = 0
+    fail_prefix = None
+
+    def __init__(self, *args, **kwargs):
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def count_call(self):
+        time.sleep(self.delay)
+        with self.lock:
+            self.calls += 1
+
+    def list_blobs(self, bucket_name, prefix=None, delimiter=None):
+        if prefix == self.fail_prefix:
+            raise RuntimeError('{} failed'.format(prefix))
+        return FakeIterator(self, self.names, prefix or '', delimiter)
+
+
+@pytest.fixture
+def connector(monkeypatch):
+    monkeypatch.setattr(gstorage.storage, 'Client', FakeClient)
+    FakeClient.names = sorted(['data/top.txt'] + ['data/{:04d}/part-{}'.format(shard, part)
+                                                  for shard in range(500) for part in range(3)])
+    FakeClient.delay = 0
+    FakeClient.fail_prefix = None
+    return GStorageConnector()
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_lists_every_blob(connector, ordered):
+    names = [blob.name for blob in connector.list_blobs_sharded('bucket', 'data/', ordered=ordered, max_workers=4)]
+
+    if ordered:
+        assert names == FakeClient.names
+    else:
+        assert sorted(names) == FakeClient.names
+
+
+def test_reverse(connector):
+    names = [blob.name for blob in connector.list_blobs_sharded('bucket', 'data/', reverse=True, max_workers=4)]
+
+    assert names == FakeClient.names[::-1]
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_close_does_not_list_pending_shards(connector, ordered):
+    FakeClient.delay = 0.005
+    blobs = connector.list_blobs_sharded('bucket', 'data/', ordered=ordered, max_workers=4)
+    next(blobs)
+    blobs.close()
+
+    # the delimiter listing pages read so far and the shards already running, not the 500 shards
+    assert connector.service.calls < 50
+
+
+def test_shard_error_stops_listing(connector):
+    FakeClient.delay = 0.005
+    FakeClient.fail_prefix = 'data/0002/'
+
+    with pytest.raises(RuntimeError, match='data/0002/ failed'):
+        list(connector.list_blobs_sharded('bucket', 'data/', ordered=False, max_workers=4))
+    assert connector.service.calls < 50
@@ -0,0 +1,75 @@
+"""
+Runs GStorageConnector.pd_to_gstorage_stream against a fake GCS server, e.g. fake-gcs-server or
+gcp-storage-emulator, reached through STORAGE_EMULATOR_HOST:
+
+    gcp-storage-emulator start --port 9023 --in-memory &
+    STORAGE_EMULATOR_HOST=http://localhost:9023 python -m pytest tests/test_gstorage_stream.py
+"""
+import io
+import os
+import uuid
+
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+from gcloud_connectors.gstorage import GStorageConnector
+
+pytestmark = pytest.mark.skipif('STORAGE_EMULATOR_HOST' not in os.environ,
+                                reason='STORAGE_EMULATOR_HOST is not set')
+
+
+@pytest.fixture
+def connector():
+    connector = GStorageConnector()
+    bucket_name = 'test-{}'.format(uuid.uuid4().hex)
+    connector.service.create_bucket(bucket_name)
+    connector.bucket_name = bucket_name
+    return connector
+
+
+def read_parquet(connector, name):
+    data = connector.service.bucket(connector.bucket_name).blob(name).download_as_bytes()
+    return pq.ParquetFile(io.BytesIO(data))
+
+
+def test_row_groups(connector):
+    df = pd.DataFrame({'a': range(2500), 'b': ['x{}'.format(i) for i in range(2500)]})
+    assert connector.pd_to_gstorage_stream(df, connector.bucket_name, 'df.parquet', row_group_size=1000,
+                                           chunk_size=256 * 1024)
+
+    parquet_file = read_parquet(connector, 'df.parquet')
+    assert parquet_file.metadata.num_row_groups == 3
+    pd.testing.assert_frame_equal(parquet_file.read().to_pandas(), df)
+
+
+def test_iterator(connector):
+    frames = [pd.DataFrame({'a': [1, 2], 's': [None, None]}), pd.DataFrame({'a': [3], 's': ['x']})]
+    connector.pd_to_gstorage_stream(iter(frames), connector.bucket_name, 'frames.parquet', row_group_size=10)
+
+    df = read_parquet(connector, 'frames.parquet').read().to_pandas()
+    assert df['s'].tolist() == [None, None, 'x']
+
+
+def test_empty_dataframe_keeps_schema(connector):
+    df = pd.DataFrame({'a': pd.Series([], dtype='int64'), 'b': pd.Series([], dtype='object')})
+    assert connector.pd_to_gstorage_stream(df, connector.bucket_name, 'empty.parquet')
+
+    parquet_file = read_parquet(connector, 'empty.parquet')
+    assert parquet_file.metadata.num_rows == 0
+    assert parquet_file.schema_arrow.names == ['a', 'b']
+
+
+def test_empty_iterator_raises(connector):
+    with pytest.raises(ValueError):
+        connector.pd_to_gstorage_stream(iter([]), connector.bucket_name, 'none.parquet')
+    assert connector.service.bucket(connector.bucket_name).get_blob('none.parquet') is None
+
+
+def test_iterator_null_first_row_group(connector):
+    frames = [pd.DataFrame({'a': [1, 2], 's': [None, None]}), pd.DataFrame({'a': [3], 's': ['x']})]
+    connector.pd_to_gstorage_stream(iter(frames), connector.bucket_name, 'null_first.parquet', row_group_size=2)
+
+    parquet_file = read_parquet(connector, 'null_first.parquet')
+    assert str(parquet_file.schema_arrow.field('s').type) == 'string'
+    assert parquet_file.read().to_pandas()['s'].tolist() == [None, None, 'x']
@@ -0,0 +1,23 @@
+"""
+Checks that ResultCache keys only match queries returning the same results.
+"""
+from gcloud_connectors.cache import ResultCache
+from gcloud_connectors.cache import normalize_sql
+
+
+def test_line_comment_does_not_swallow_next_line():
+    both_columns = 'SELECT a -- x\n, b FROM t'
+    first_column = 'SELECT a -- x , b\nFROM t'
+
+    assert normalize_sql(both_columns) == 'SELECT a , b FROM t'
+    assert normalize_sql(first_column) == 'SELECT a FROM t'
+    assert ResultCache.get_key(both_columns, 'p') != ResultCache.get_key(first_column, 'p')
+
+
+def test_comments_and_whitespace_are_ignored():
+    assert ResultCache.get_key('SELECT a,\n  b # columns\nFROM /* source */ t;', 'p') == \
+        ResultCache.get_key('SELECT a, b FROM t', 'p')
+
+
+def test_literals_are_kept():
+    assert normalize_sql("SELECT '-- a  #b' AS c, \"/* d */\"  FROM t") == "SELECT '-- a  #b' AS c, \"/* d */\" FROM t"